@@ -1,14 +1,17 @@
 import argparse
 import os
 import ssl
+import sys
 from datetime import datetime, timedelta
 
 from bilibili_api.comment import CommentResourceType
-from flask import Flask, render_template, request, Response
+from flask import Flask, jsonify, render_template, request, Response
 from flask_cors import CORS, cross_origin
 
-from config import Config
-from dataset import db, Comment
+from config import Config, add_arguments
+from dataset import db, Comment, CounterChanges, STATUS_FLAGGED, deletable_comments, flag_comments, on_new_content, \
+    rank_bad_users, read_statistics, rebuild_reputation, top_reputations, upgrade_schema
+from pagination import KeysetPage
 from scraper import Scraper
 
 app = Flask(__name__)
@@ -20,14 +23,9 @@ def get_statistics():
     """Get statistics for the dashboard"""
     stats = {
         'last_refreshed': datetime.now() - scraper.last_refreshed if scraper.last_refreshed else None,
-        'total_comments': Comment.query.count(),
-        'video_comments': Comment.query.filter_by(type_=CommentResourceType.VIDEO.value).count(),
-        'dynamic_comments': Comment.query.filter(Comment.type_.in_([
-            CommentResourceType.DYNAMIC.value, CommentResourceType.DYNAMIC_DRAW.value
-        ])).count(),
-        'flagged_comments': Comment.query.filter(Comment.guardian_status == 2).count(),
-        'deleted_comments': Comment.query.filter(Comment.guardian_status == -1).count(),
     }
+    # 评论数等计数由写入路径增量维护，这里只读一次计数表
+    stats.update(read_statistics(db.session))
     
     # 爬虫的评论处理速率
     if hasattr(scraper, 'scraper_stats'):
@@ -51,24 +49,32 @@ def get_statistics():
         stats['videos_per_minute'] = 0
         stats['recent_comments'] = 0
         stats['recent_videos'] = 0
-    
-    # Calculate unique content stats
-    stats['unique_videos'] = db.session.query(Comment.oid).filter_by(type_=CommentResourceType.VIDEO.value).distinct().count()
-    stats['unique_dynamics'] = db.session.query(Comment.oid).filter(Comment.type_.in_([
-        CommentResourceType.DYNAMIC.value, CommentResourceType.DYNAMIC_DRAW.value
-    ])).distinct().count()
-    
-    # Get unique commenters
-    stats['unique_users'] = db.session.query(Comment.mid).distinct().count()
+
+    # 各接口熔断器状态
+    stats['breakers'] = scraper.breaker_status()
+    # 凭据池中各账号的使用情况
+    stats['credentials'] = scraper.credential_status()
+    # 数据库写入队列
+    stats['writer'] = scraper.writer_status()
     
     return stats
 
 
+@app.before_request
+def use_reader():
+    """页面请求的查询走只读连接，不必等待抓取线程提交
+
+    修改数据的请求要基于最新的守护状态计算，读写都走写连接。
+    """
+    db.session.info['read_only'] = request.method in ('GET', 'HEAD')
+
+
 @cross_origin()
 @app.route('/comments', methods=['GET'])
 def comments():  # put application's code here
     type_ = request.args.get('type')
     page = request.args.get('pn')
+    uploader = request.args.get('uploader', type=int)
     if type_ != "dynamic":
         type_ = "video"
     if page is None:
@@ -76,23 +82,32 @@ def comments():  # put application's code here
     else:
         page = int(page)
     per_page = 50
+    stats = get_statistics()
+    query = Comment.query.filter(Comment.guardian_status != -1)
+    if uploader is not None:
+        query = query.filter(Comment.uploader == uploader)
     if type_ == "dynamic":
-        page_comments = Comment.query. \
-            filter(Comment.guardian_status != -1). \
-            filter(Comment.type_.in_([CommentResourceType.DYNAMIC.value, CommentResourceType.DYNAMIC_DRAW.value])). \
-            order_by(Comment.ctime.desc()).paginate(page, per_page, error_out=False)
+        # 每种动态类型单独查询后合并，各自沿 (type_, ctime) 索引读取，不用 IN 条件整体排序
+        types = [CommentResourceType.DYNAMIC, CommentResourceType.DYNAMIC_DRAW]
+        total = stats['dynamic_comments']
     else:
-        page_comments = Comment.query. \
-            filter(Comment.guardian_status != -1). \
-            filter_by(type_=CommentResourceType.VIDEO.value). \
-            order_by(Comment.ctime.desc()).paginate(page, per_page, error_out=False)
-    
-    stats = get_statistics()
+        types = [CommentResourceType.VIDEO]
+        total = stats['video_comments']
+    # 总页数按计数表估计，筛选 UP 主时没有对应的计数，不显示总页数
+    page_comments = KeysetPage(
+        [query.filter_by(type_=resource_type.value) for resource_type in types], per_page,
+        after=request.args.get('after'),
+        before=request.args.get('before'),
+        page=page,
+        total=total if uploader is None else None
+    )
     
     return render_template(
         'comments.html',
         comments=page_comments,
         type_=type_,
+        uploader=uploader,
+        uploaders=scraper.uploaders(),
         last_refreshed=stats['last_refreshed'],
         stats=stats
     )
@@ -109,46 +124,59 @@ def try_delete_comment():
         if comment.guardian_status not in [0, 1]:
             return Response('{"message":"评论已被删除或正在被删除"}', status=304, mimetype='application/json')
         else:
-            comment.guardian_status = 2
+            changes = CounterChanges()
+            changes.status_changed(comment.mid, comment.guardian_status, STATUS_FLAGGED)
+            comment.guardian_status = STATUS_FLAGGED
+            changes.apply(db.session)
             db.session.commit()
             return Response('{"message":"已经记录"}', status=202, mimetype='application/json')
 
 
+@cross_origin()
+@app.route('/try_delete_comments', methods=['POST'])
+def try_delete_comments():
+    """批量记录已在 B 站删除的评论，请求体为 {"rpids": [...]}，返回每条评论的处理结果"""
+    payload = request.get_json(silent=True) or {}
+    rpids = payload.get('rpids')
+    if not isinstance(rpids, list):
+        return jsonify(message="请求中缺少 rpids 列表"), 400
+    results = {}
+    valid = []
+    for rpid in rpids:
+        try:
+            valid.append(int(rpid))
+        except (TypeError, ValueError):
+            results[str(rpid)] = "invalid"
+    results.update({str(rpid): result for rpid, result in flag_comments(db.session, valid).items()})
+    db.session.commit()
+    return jsonify(results=results)
+
+
 @cross_origin()
 @app.route('/bad_users', methods=['GET'])
 def bad_users():  # put application's code here
-    all_deleted_comments = Comment.query.filter(Comment.guardian_status == -1).all()
-    user_count_list = {}
-    for comment in all_deleted_comments:
-        if comment.mid in user_count_list:
-            user_count_list[comment.mid]["count"] += 1
-            user_count_list[comment.mid]["last"] = comment
-        else:
-            user_count_list[comment.mid] = {
-                "count": 1,
-                "last": comment
-            }
-
+    uploader = request.args.get('uploader', type=int)
     users = [{
-        "uid": user_count["last"].mid,
-        "uname": user_count["last"].mname,
-        "last": user_count["last"].create_time_utc8(),
-        "count": user_count["count"],
+        "uid": mid,
+        "uname": mname,
+        "last": ctime + timedelta(hours=8),
+        "count": count,
         "top_bad": False
-    } for user_count in user_count_list.values()]
+    } for mid, mname, ctime, count in (
+        # 用户信誉表只有全局计数，按 UP 主筛选时现场聚合
+        top_reputations(db.session) if uploader is None else rank_bad_users(db.session, uploader)
+    )]
 
-    users.sort(key=lambda user: user["count"], reverse=True)
-
-    for user_id, user_obj in enumerate(users[:9]):
-        user_comments = Comment.query. \
-            filter(~Comment.oid.in_(scraper.new_video_oids + scraper.new_dynamic_oids)). \
-            filter(Comment.mid == user_obj["uid"]). \
-            filter(Comment.guardian_status.in_([0, 1])). \
-            all()
-        user_comments_json = \
-            [{"type": comment.type_, "oid": str(comment.oid), "rpid": str(comment.rpid)} for comment in user_comments]
-        users[user_id]['comments'] = user_comments_json
-        users[user_id]['top_bad'] = True
+    conditions = [~on_new_content()]
+    if uploader is not None:
+        conditions.append(Comment.uploader == uploader)
+    top_users = users[:9]
+    user_comments = deletable_comments(db.session, [user_obj["uid"] for user_obj in top_users], *conditions)
+    for user_obj in top_users:
+        user_obj['comments'] = [
+            {"type": type_, "oid": str(oid), "rpid": str(rpid)} for type_, oid, rpid in user_comments[user_obj["uid"]]
+        ]
+        user_obj['top_bad'] = True
     
     stats = get_statistics()
     
@@ -156,6 +184,8 @@ def bad_users():  # put application's code here
         'bad_users.html',
         users=users,
         type_="bad_users",
+        uploader=uploader,
+        uploaders=scraper.uploaders(),
         last_refreshed=stats['last_refreshed'],
         stats=stats
     )
@@ -236,18 +266,18 @@ def generate_ssl_context(cert_dir="ssl"):
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Start Bilibili guardian server")
-    parser.add_argument('--db', type=str, help="path to database file", required=True)
-    parser.add_argument('--user', type=int, help="user id")
-    parser.add_argument('--video_count', type=int, help="video count")
-    parser.add_argument('--dynamic_count', type=int, help="dynamic count")
-    parser.add_argument('--max_page', type=int, help="maximum pages to scrap")
-    parser.add_argument('--username', type=str, help="username")
-    parser.add_argument('--password', type=str, help="password")
-    parser.add_argument('--sessdata', type=str, help="sessdata")
-    parser.add_argument('--bili_jct', type=str, help="bili_jct")
-    parser.add_argument('--buvid3', type=str, help="buvid3 cookie")
+    parser.add_argument('--db', type=str, required=True,
+                        help="database URI, e.g. sqlite:////data/db.sqlite or postgresql://user@host/guardian")
+    add_arguments(parser)
+    parser.add_argument('--no_scraper', action='store_true', help="only serve pages, scraping runs in worker.py processes")
     parser.add_argument('--https', action='store_true', help="enable HTTPS with self-signed certificate")
     parser.add_argument('--port', type=int, default=5000, help="port to run server on")
+    parser.add_argument('--rebuild_reputation', action='store_true',
+                        help="rebuild the user reputation table from the stored comments and exit")
+    parser.add_argument('--sqlite_readers', type=int, default=8,
+                        help="read-only SQLite connections shared by page requests, 0 to disable")
+    parser.add_argument('--pool_size', type=int, help="database connections kept open (PostgreSQL)")
+    parser.add_argument('--max_overflow', type=int, help="extra database connections allowed under load (PostgreSQL)")
 
     args = parser.parse_args()
     app.jinja_env.auto_reload = True
@@ -257,31 +287,20 @@ if __name__ == '__main__':
     app.app_context().push()
 
     db.init_app(app)
-    db.create_all()
+    db.configure_engine(app, readers=args.sqlite_readers, pool_size=args.pool_size, max_overflow=args.max_overflow)
+    upgrade_schema()
+
+    if args.rebuild_reputation:
+        db.session.remove()
+        with db.engine.begin() as connection:
+            rebuild_reputation(connection)
+        print("用户信誉表已重新生成")
+        sys.exit(0)
 
-    config_dict = {}
-    if args.user is not None:
-        config_dict['user'] = args.user
-    if args.video_count is not None:
-        config_dict['video_count'] = args.video_count
-    if args.dynamic_count is not None:
-        config_dict['dynamic_count'] = args.dynamic_count
-    if args.max_page is not None:
-        config_dict['max_page'] = args.max_page
-    if args.username is not None:
-        config_dict['username'] = args.username
-    if args.password is not None:
-        config_dict['password'] = args.password
-    if args.sessdata is not None:
-        config_dict['sessdata'] = args.sessdata
-    if args.bili_jct is not None:
-        config_dict['bili_jct'] = args.bili_jct
-    if args.buvid3 is not None:
-        config_dict['buvid3'] = args.buvid3
     if 'URL' in os.environ:
         app.config['SERVER_NAME'] = os.environ['URL']
 
-    config = Config(**config_dict)
+    config = Config.from_args(args)
     scraper = Scraper(config, db, app)
     
     # Use asyncio to run Flask properly with the new scraper setup
@@ -289,7 +308,8 @@ if __name__ == '__main__':
     from werkzeug.serving import run_simple
     
     # Set up scraper in event loop
-    scraper.run_scraper()
+    if not args.no_scraper:
+        scraper.run_scraper()
     
     # Run Flask with the existing event loop
     ssl_context = None
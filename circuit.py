@@ -0,0 +1,111 @@
+import random
+import time
+from typing import Optional
+
+from bilibili_api import exceptions
+
+# 表示接口被风控拦截的错误代码
+BLOCKED_CODES = (-412, -352)
+
+
+def is_blocked(err: Exception) -> bool:
+    """判断异常是否表示接口被屏蔽"""
+    if isinstance(err, exceptions.NetworkException):
+        return True
+    return isinstance(err, exceptions.ResponseCodeException) and err.code in BLOCKED_CODES
+
+
+class CircuitOpenError(Exception):
+    """熔断器打开时直接拒绝请求"""
+
+    def __init__(self, breaker: 'CircuitBreaker'):
+        self.breaker = breaker
+        self.retry_in = breaker.retry_in()
+        super().__init__(f"接口{breaker.label}已熔断，{self.retry_in:.0f}秒后重试")
+
+
+class CircuitBreaker:
+    """单个接口类别的熔断器
+
+    连续被屏蔽 threshold 次后打开，打开期间请求直接失败；等待时间按指数增长并加入随机抖动，
+    到期后进入半开状态放行一个探测请求，成功则关闭，失败则以更长的等待时间重新打开。
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, label: str = None, threshold: int = 3, base_delay: float = 120,
+                 max_delay: float = 3600):
+        self.name = name
+        self.label = label or name
+        self.threshold = threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.state = self.CLOSED
+        self.failures = 0  # 连续失败次数
+        self.level = 0  # 连续打开次数，决定下次等待时间
+        self.retry_at: Optional[float] = None
+        self.probing = False
+        self.total_blocks = 0
+
+    def retry_in(self) -> float:
+        if self.retry_at is None:
+            return 0
+        return max(0.0, self.retry_at - time.monotonic())
+
+    def before_call(self) -> bool:
+        """请求前调用，熔断时抛出 CircuitOpenError；返回本次请求是否为半开状态下的探测请求"""
+        if self.state == self.OPEN:
+            if self.retry_in() > 0:
+                raise CircuitOpenError(self)
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            if self.probing:
+                raise CircuitOpenError(self)
+            self.probing = True
+            return True
+        return False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.level = 0
+        self.retry_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.total_blocks += 1
+        if self.state == self.OPEN:
+            # 打开前已经发出的请求陆续失败，不再重复计时
+            return
+        if self.state == self.HALF_OPEN:
+            # 探测失败，以更长的等待时间重新打开
+            self.level += 1
+            self.open()
+        else:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.open()
+        self.probing = False
+
+    def open(self):
+        delay = min(self.max_delay, self.base_delay * (2 ** self.level))
+        delay = random.uniform(delay / 2, delay)
+        self.state = self.OPEN
+        self.failures = 0
+        self.retry_at = time.monotonic() + delay
+        print(f"接口{self.label}被屏蔽，熔断{delay:.0f}秒")
+
+    def release(self):
+        """探测请求因其他原因失败或被取消时释放半开探测名额"""
+        self.probing = False
+
+    def status(self) -> dict:
+        return {
+            'name': self.name,
+            'label': self.label,
+            'state': self.state,
+            'failures': self.failures,
+            'total_blocks': self.total_blocks,
+            'retry_in': round(self.retry_in()),
+        }
@@ -1,20 +1,70 @@
 from bilibili_api import Credential
 
+from credentials import DEFAULT_BUVID3, load_credential_file
+from ratelimit import parse_rate_limit
+
 
 class Config:
     user: int
+    users: list
     video_count: int
     dynamic_count: int
     max_page: int
+    video_concurrency: int
+    dynamic_concurrency: int
+    sub_comment_concurrency: int
+    incremental: bool
+    full_scan_interval: int
+    min_poll_interval: int
+    max_poll_interval: int
+    content_refresh_interval: int
+    content_full_refresh_every: int
+    rate_limits: dict
+    breaker_threshold: int
+    breaker_base_delay: int
+    breaker_max_delay: int
+    credentials: list
+    credential_park_time: int
+    write_queue_size: int
+    write_batch_size: int
+    write_batch_delay: float
+    stats_reconcile_interval: int
+    moderation: bool
+    disable_moderation: bool
+    moderation_batch_size: int
+    moderation_interval: int
     url: str
 
-    def __init__(self, user=941228, video_count=50, dynamic_count=50, max_page=10,
+    def __init__(self, user=941228, users=None, video_count=50, dynamic_count=50, max_page=10,
+                 video_concurrency=3, dynamic_concurrency=3, sub_comment_concurrency=4,
+                 incremental=True, full_scan_interval=3600,
+                 min_poll_interval=60, max_poll_interval=86400, content_refresh_interval=300,
+                 content_full_refresh_every=12,
+                 rate_limits=None, breaker_threshold=3, breaker_base_delay=120, breaker_max_delay=3600,
                  username=None, password=None,
-                 sessdata=None, bili_jct=None, buvid3=None):
-        self.user = user
+                 sessdata=None, bili_jct=None, buvid3=None,
+                 credential_file=None, credential_park_time=600,
+                 write_queue_size=16, write_batch_size=8, write_batch_delay=0.05,
+                 stats_reconcile_interval=3600,
+                 moderation=False, disable_moderation=False, moderation_batch_size=20, moderation_interval=30):
+        self.users = list(users) if users else [user]  # 监控的 UP 主列表
+        self.user = self.users[0]
         self.video_count = video_count
         self.dynamic_count = dynamic_count
         self.max_page = max_page
+        self.video_concurrency = video_concurrency
+        self.dynamic_concurrency = dynamic_concurrency
+        self.sub_comment_concurrency = sub_comment_concurrency  # 同时分页抓取子评论的根评论数
+        self.incremental = incremental
+        self.full_scan_interval = full_scan_interval  # 增量模式下完整重扫的间隔（秒）
+        self.min_poll_interval = min_poll_interval  # 活跃对象的最短轮询间隔（秒）
+        self.max_poll_interval = max_poll_interval  # 冷门对象的最长轮询间隔（秒）
+        self.content_refresh_interval = content_refresh_interval  # 刷新视频/动态列表的间隔（秒）
+        self.content_full_refresh_every = content_full_refresh_every  # 每隔多少次刷新完整重新抓取列表
+        self.rate_limits = rate_limits or {}  # {接口类别: (每秒请求数, 突发容量)}，未指定的使用默认值
+        self.breaker_threshold = breaker_threshold  # 连续被屏蔽多少次后熔断
+        self.breaker_base_delay = breaker_base_delay  # 首次熔断的等待时间（秒），之后指数增长
+        self.breaker_max_delay = breaker_max_delay  # 熔断等待时间上限（秒）
         self.username = username
         self.password = password
         self.credential = None
@@ -24,5 +74,142 @@ class Config:
             self.credential = Credential(
                 sessdata=sessdata,
                 bili_jct=bili_jct,
-                buvid3=buvid3 or "6FEFA119-C949-48A2-9D7C-320155B3460E167612infoc"
+                buvid3=buvid3 or DEFAULT_BUVID3
             )
+
+        # UP 主本人的凭据，只能由 --sessdata 和 --bili_jct 给出；自动删除评论只使用这个凭据
+        self.uploader_credential = self.credential
+
+        # 凭据池：命令行给出的凭据加上凭据文件中的每一行
+        self.credentials = [self.credential] if self.credential is not None else []
+        if credential_file is not None:
+            self.credentials += load_credential_file(credential_file)
+        if self.credential is None and self.credentials:
+            self.credential = self.credentials[0]
+        self.credential_park_time = credential_park_time  # 凭据被屏蔽后暂停使用的时间（秒）
+        self.write_queue_size = write_queue_size  # 等待写入数据库的对象数上限，超过时抓取暂停
+        self.write_batch_size = write_batch_size  # 一次提交最多合并的对象数
+        self.write_batch_delay = write_batch_delay  # 合并提交前等待更多对象的时间（秒）
+        self.stats_reconcile_interval = stats_reconcile_interval  # 重新统计仪表盘计数的间隔（秒）
+        self.moderation = moderation  # 是否在抓取进程中自动删除已标记的评论，需要 UP 主本人的凭据
+        self.disable_moderation = disable_moderation  # 为整个数据库关闭自动删除，重新抓取时仍可见的已标记评论恢复可见
+        self.moderation_batch_size = moderation_batch_size  # 每轮取出的已标记评论数
+        self.moderation_interval = moderation_interval  # 没有已标记评论时的等待时间（秒）
+
+    @staticmethod
+    def from_args(args) -> 'Config':
+        """由 add_arguments 定义的命令行参数构造配置，未给出的参数使用默认值"""
+        config_dict = {}
+        if args.user is not None:
+            config_dict['users'] = args.user
+        if args.video_count is not None:
+            config_dict['video_count'] = args.video_count
+        if args.dynamic_count is not None:
+            config_dict['dynamic_count'] = args.dynamic_count
+        if args.max_page is not None:
+            config_dict['max_page'] = args.max_page
+        if args.video_concurrency is not None:
+            config_dict['video_concurrency'] = args.video_concurrency
+        if args.dynamic_concurrency is not None:
+            config_dict['dynamic_concurrency'] = args.dynamic_concurrency
+        if args.sub_comment_concurrency is not None:
+            config_dict['sub_comment_concurrency'] = args.sub_comment_concurrency
+        if args.no_incremental:
+            config_dict['incremental'] = False
+        if args.full_scan_interval is not None:
+            config_dict['full_scan_interval'] = args.full_scan_interval
+        if args.min_poll_interval is not None:
+            config_dict['min_poll_interval'] = args.min_poll_interval
+        if args.max_poll_interval is not None:
+            config_dict['max_poll_interval'] = args.max_poll_interval
+        if args.content_refresh_interval is not None:
+            config_dict['content_refresh_interval'] = args.content_refresh_interval
+        if args.content_full_refresh_every is not None:
+            config_dict['content_full_refresh_every'] = args.content_full_refresh_every
+        if args.rate_limit:
+            config_dict['rate_limits'] = dict(args.rate_limit)
+        if args.breaker_threshold is not None:
+            config_dict['breaker_threshold'] = args.breaker_threshold
+        if args.breaker_base_delay is not None:
+            config_dict['breaker_base_delay'] = args.breaker_base_delay
+        if args.breaker_max_delay is not None:
+            config_dict['breaker_max_delay'] = args.breaker_max_delay
+        if args.username is not None:
+            config_dict['username'] = args.username
+        if args.password is not None:
+            config_dict['password'] = args.password
+        if args.sessdata is not None:
+            config_dict['sessdata'] = args.sessdata
+        if args.bili_jct is not None:
+            config_dict['bili_jct'] = args.bili_jct
+        if args.buvid3 is not None:
+            config_dict['buvid3'] = args.buvid3
+        if args.credential_file is not None:
+            config_dict['credential_file'] = args.credential_file
+        if args.credential_park_time is not None:
+            config_dict['credential_park_time'] = args.credential_park_time
+        if args.write_queue_size is not None:
+            config_dict['write_queue_size'] = args.write_queue_size
+        if args.write_batch_size is not None:
+            config_dict['write_batch_size'] = args.write_batch_size
+        if args.write_batch_delay is not None:
+            config_dict['write_batch_delay'] = args.write_batch_delay
+        if args.stats_reconcile_interval is not None:
+            config_dict['stats_reconcile_interval'] = args.stats_reconcile_interval
+        if args.moderation:
+            config_dict['moderation'] = True
+        if args.disable_moderation:
+            config_dict['disable_moderation'] = True
+        if args.moderation_batch_size is not None:
+            config_dict['moderation_batch_size'] = args.moderation_batch_size
+        if args.moderation_interval is not None:
+            config_dict['moderation_interval'] = args.moderation_interval
+        return Config(**config_dict)
+
+
+def add_arguments(parser):
+    """添加服务器和独立抓取进程共用的抓取相关参数"""
+    parser.add_argument('--user', type=int, nargs='+', help="user id(s) of the uploaders to monitor")
+    parser.add_argument('--video_count', type=int, help="video count")
+    parser.add_argument('--dynamic_count', type=int, help="dynamic count")
+    parser.add_argument('--max_page', type=int, help="maximum pages to scrap")
+    parser.add_argument('--video_concurrency', type=int, help="number of videos scraped concurrently")
+    parser.add_argument('--dynamic_concurrency', type=int, help="number of dynamics scraped concurrently")
+    parser.add_argument('--sub_comment_concurrency', type=int, help="number of comment threads paged concurrently")
+    parser.add_argument('--no_incremental', action='store_true', help="always scrap up to max_page pages")
+    parser.add_argument('--full_scan_interval', type=int, help="seconds between full re-scans in incremental mode")
+    parser.add_argument('--min_poll_interval', type=int, help="shortest polling interval of an object in seconds")
+    parser.add_argument('--max_poll_interval', type=int, help="longest polling interval of an object in seconds")
+    parser.add_argument('--content_refresh_interval', type=int, help="seconds between video/dynamic list refreshes")
+    parser.add_argument('--content_full_refresh_every', type=int,
+                        help="re-list all videos/dynamics every N refreshes instead of only the first page")
+    parser.add_argument('--rate_limit', type=parse_rate_limit, action='append',
+                        help="per-endpoint rate limit as endpoint=rate:burst, e.g. comment=3:6 "
+                             "(endpoints: comment, sub_comment, video_list, dynamic_list, moderation)")
+    parser.add_argument('--breaker_threshold', type=int, help="consecutive blocks before an endpoint is paused")
+    parser.add_argument('--breaker_base_delay', type=int, help="seconds an endpoint is paused after the first block")
+    parser.add_argument('--breaker_max_delay', type=int, help="longest pause of a blocked endpoint in seconds")
+    parser.add_argument('--username', type=str, help="username")
+    parser.add_argument('--password', type=str, help="password")
+    parser.add_argument('--sessdata', type=str, help="sessdata")
+    parser.add_argument('--bili_jct', type=str, help="bili_jct")
+    parser.add_argument('--buvid3', type=str, help="buvid3 cookie")
+    parser.add_argument('--credential_file', type=str,
+                        help="file with one cookie set (SESSDATA=...; bili_jct=...; buvid3=...) per line")
+    parser.add_argument('--credential_park_time', type=int, help="seconds a blocked credential is left unused")
+    parser.add_argument('--write_queue_size', type=int,
+                        help="objects waiting for the database writer before scraping is held back")
+    parser.add_argument('--write_batch_size', type=int, help="objects written in one database commit at most")
+    parser.add_argument('--write_batch_delay', type=float,
+                        help="seconds the writer waits to group more objects into one commit")
+    parser.add_argument('--stats_reconcile_interval', type=int,
+                        help="seconds between recounting the dashboard statistics to correct drift")
+    parser.add_argument('--moderation', action='store_true',
+                        help="delete flagged comments through the reply API "
+                             "(requires the uploader's own --sessdata and --bili_jct); "
+                             "every process sharing the database then keeps flagged comments until they are deleted")
+    parser.add_argument('--disable_moderation', action='store_true',
+                        help="turn automatic deletion off for every process sharing the database, "
+                             "so flagged comments that are still visible are reset on rescans")
+    parser.add_argument('--moderation_batch_size', type=int, help="flagged comments deleted per round")
+    parser.add_argument('--moderation_interval', type=int, help="seconds to wait when no comment is flagged")
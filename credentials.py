@@ -0,0 +1,109 @@
+import time
+from typing import Optional
+
+from bilibili_api import Credential
+
+DEFAULT_BUVID3 = "6FEFA119-C949-48A2-9D7C-320155B3460E167612infoc"
+
+
+def parse_cookie_line(line: str) -> Optional[Credential]:
+    """解析一行 Cookie（SESSDATA=...; bili_jct=...; buvid3=...），缺少必要字段时返回 None"""
+    cookies = {}
+    for part in line.split(';'):
+        key, sep, value = part.strip().partition('=')
+        if sep:
+            cookies[key.strip()] = value.strip()
+    if 'SESSDATA' not in cookies or 'bili_jct' not in cookies:
+        return None
+    return Credential(
+        sessdata=cookies['SESSDATA'],
+        bili_jct=cookies['bili_jct'],
+        buvid3=cookies.get('buvid3') or DEFAULT_BUVID3,
+        dedeuserid=cookies.get('DedeUserID')
+    )
+
+
+def load_credential_file(path: str) -> list:
+    """读取凭据文件，每行一组 Cookie，空行和 # 开头的行会被忽略"""
+    credentials = []
+    with open(path, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            credential = parse_cookie_line(line)
+            if credential is None:
+                print(f"凭据文件第{line_number}行缺少 SESSDATA 或 bili_jct，已忽略")
+            else:
+                credentials.append(credential)
+    return credentials
+
+
+class PooledCredential:
+    """凭据池中的一个账号及其使用统计"""
+
+    def __init__(self, credential: Optional[Credential], name: str):
+        self.credential = credential
+        self.name = name
+        self.calls = 0
+        self.errors = 0
+        self.blocks = 0
+        self.consecutive_blocks = 0
+        self.last_used = 0.0
+        self.parked_until = 0.0
+
+    def parked(self) -> bool:
+        return self.parked_until > time.monotonic()
+
+    def status(self) -> dict:
+        return {
+            'name': self.name,
+            'calls': self.calls,
+            'errors': self.errors,
+            'blocks': self.blocks,
+            'parked': self.parked(),
+            'parked_for': round(max(0.0, self.parked_until - time.monotonic())),
+        }
+
+
+class CredentialPool:
+    """在可用凭据之间轮换请求，被屏蔽的凭据暂停使用一段时间"""
+
+    def __init__(self, credentials: list, park_time: float = 600):
+        self.park_time = park_time
+        if credentials:
+            self.members = [
+                PooledCredential(credential, f"账号{i + 1}" + (
+                    f" ({credential.dedeuserid})" if getattr(credential, 'dedeuserid', None) else ""
+                ))
+                for i, credential in enumerate(credentials)
+            ]
+        else:
+            self.members = [PooledCredential(None, "匿名")]
+
+    def acquire(self) -> PooledCredential:
+        """取最久未使用的可用凭据；全部被暂停时取最早恢复的那个"""
+        healthy = [member for member in self.members if not member.parked()]
+        if healthy:
+            member = min(healthy, key=lambda m: m.last_used)
+        else:
+            member = min(self.members, key=lambda m: m.parked_until)
+        member.calls += 1
+        member.last_used = time.monotonic()
+        return member
+
+    @staticmethod
+    def report_success(member: PooledCredential):
+        member.consecutive_blocks = 0
+
+    def report_failure(self, member: PooledCredential, blocked: bool):
+        member.errors += 1
+        if blocked:
+            member.blocks += 1
+            member.consecutive_blocks += 1
+            park_time = self.park_time * (2 ** min(member.consecutive_blocks - 1, 4))
+            member.parked_until = time.monotonic() + park_time
+            print(f"{member.name}被屏蔽，暂停使用{park_time:.0f}秒")
+
+    def status(self) -> list:
+        return [member.status() for member in self.members]
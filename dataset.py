@@ -1,30 +1,144 @@
 import json
+from array import array
+from collections import Counter, defaultdict
 from datetime import datetime, timedelta
+from typing import Optional
 
 from bilibili_api.comment import CommentResourceType
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, Integer, DateTime, Text
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import BigInteger, Boolean, Column, Index, Integer, DateTime, Float, LargeBinary, Text, and_, create_engine, event, \
+    bindparam, case, exists, func, inspect, or_, orm, select, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql import column, table
+from sqlalchemy.sql.dml import UpdateBase
 
-db = SQLAlchemy()
+# SQLite 连接设置
+SQLITE_BUSY_TIMEOUT = 30000  # 等待写锁的时间（毫秒）
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024  # 内存映射读取的字节数
+SQLITE_CACHE_SIZE = -64000  # 每个连接的页缓存，负数表示 KiB
+
+
+def sqlite_pragmas(read_only: bool):
+    """新建 SQLite 连接时设置的参数：WAL 模式下读写互不阻塞，写入只在检查点时同步到磁盘"""
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        cursor.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+        if read_only:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+    return on_connect
+
+
+# 评论、内容和用户 ID 超出 32 位整数范围；SQLite 的 INTEGER 本身就是 64 位，保持原有的建表语句
+BigId = BigInteger().with_variant(Integer(), 'sqlite')
+
+
+class RoutingSession(SignallingSession):
+    """info['read_only'] 为真的会话中，查询走只读连接池，刷新和 INSERT/UPDATE/DELETE 语句仍走写连接"""
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.db.reader_engine is not None and self.info.get('read_only') and not self._flushing \
+                and not isinstance(clause, UpdateBase):
+            return self.db.reader_engine
+        return super().get_bind(mapper, clause)
+
+
+class GuardianSQLAlchemy(SQLAlchemy):
+    reader_engine = None  # 只读连接池，未配置时所有操作都走默认连接
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def configure_engine(self, app: Flask, readers: int = 0, pool_size: Optional[int] = None,
+                         max_overflow: Optional[int] = None):
+        """设置数据库连接，需在 init_app 之后、首次连接数据库之前调用
+
+        SQLite：readers 大于 0 时，写操作共用唯一的一个写连接，标记为只读的会话从 readers 个只读连接中取连接查询。
+        其他数据库（如 PostgreSQL）：按 pool_size 和 max_overflow 设置连接池大小。
+        """
+        url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+        if url.get_backend_name() != 'sqlite':
+            options = app.config['SQLALCHEMY_ENGINE_OPTIONS']
+            options['pool_pre_ping'] = True
+            if pool_size is not None:
+                options['pool_size'] = pool_size
+            if max_overflow is not None:
+                options['max_overflow'] = max_overflow
+            return
+        if url.database in (None, '', ':memory:'):
+            return
+        if readers > 0:
+            app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+                'poolclass': QueuePool,
+                'pool_size': 1,
+                'max_overflow': 0,
+                'pool_timeout': SQLITE_BUSY_TIMEOUT / 1000,
+                'connect_args': {'check_same_thread': False},
+            }
+        event.listen(self.engine, 'connect', sqlite_pragmas(read_only=False))
+        if readers > 0:
+            self.reader_engine = create_engine(
+                self.engine.url,
+                poolclass=QueuePool,
+                pool_size=readers,
+                max_overflow=0,
+                pool_timeout=SQLITE_BUSY_TIMEOUT / 1000,
+                connect_args={'check_same_thread': False}
+            )
+            event.listen(self.reader_engine, 'connect', sqlite_pragmas(read_only=True))
+
+
+db = GuardianSQLAlchemy()
 
 
 class Comment(db.Model):
     __tablename__ = 'comment'
-    rpid = Column(Integer, primary_key=True)  # 回复 ID
+    __table_args__ = (
+        # /comments 列表和按类型统计
+        Index('ix_comment_type_ctime', 'type_', 'ctime'),
+        Index('ix_comment_uploader_type_ctime', 'uploader', 'type_', 'ctime'),
+        # 按类型统计内容数
+        Index('ix_comment_type_oid', 'type_', 'oid'),
+        # 按守护状态统计和 /bad_users 查找已删除评论
+        Index('ix_comment_status_uploader', 'guardian_status', 'uploader'),
+        # /bad_users 查找用户仍可见的评论，统计评论用户数
+        Index('ix_comment_mid_status', 'mid', 'guardian_status'),
+        # update_comments 比对删除状态
+        Index('ix_comment_oid_root_ctime', 'oid', 'root', 'ctime'),
+        Index('ix_comment_root', 'root'),
+        # 部分索引：/bad_users 只关心已删除的评论和仍可删除的评论
+        Index('ix_comment_deleted_mid', 'mid', 'ctime',
+              postgresql_where=text('guardian_status = -1'), sqlite_where=text('guardian_status = -1')),
+        Index('ix_comment_visible_mid', 'mid', 'oid',
+              postgresql_where=text('guardian_status IN (0, 1)'), sqlite_where=text('guardian_status IN (0, 1)')),
+    )
+    rpid = Column(BigId, primary_key=True)  # 回复 ID
     message = Column(Text)  # 回复文本
-    oid = Column(Integer)  # 回复内容 ID
-    oname = Column(Integer)  # 回复内容标题
+    oid = Column(BigId)  # 回复内容 ID
+    oname = Column(Text)  # 回复内容标题
     type_ = Column(Integer)  # 回复内容类型
-    mid = Column(Integer)  # 回复用户 ID
-    mname = Column(Integer)  # 回复用户昵称
+    mid = Column(BigId)  # 回复用户 ID
+    mname = Column(Text)  # 回复用户昵称
     fansgrade = Column(Integer)  # 是否为粉丝
     ctime = Column(DateTime)  # 发布时间
     rcount = Column(Integer)  # 回复数目
     like = Column(Integer)  # 点赞数目
     guardian_status = Column(Integer)  # 守护状态
     raw = Column(Text)  # 原始 JSON
-    root = Column(Integer)  # 根评论
-    parent = Column(Integer)  # 回复的评论
+    root = Column(BigId)  # 根评论
+    parent = Column(BigId)  # 回复的评论
+    uploader = Column(BigId)  # 内容所属 UP 主 ID
 
     def create_time_utc8(self):
         return self.ctime + timedelta(hours=8)
@@ -75,7 +189,7 @@ class Comment(db.Model):
     def __repr__(self):
         return f"在{self.object_desc()}下用户 {self.mname} 的评论 {self.abstract_text(self.message, 10)}"
 
-    def __init__(self, user_json: dict, oname):
+    def __init__(self, user_json: dict, oname, uploader: int = None):
         self.rpid = user_json['rpid']
         self.message = user_json['content']['message']
         self.oid = user_json['oid']
@@ -91,3 +205,844 @@ class Comment(db.Model):
         self.parent = user_json.get('parent', 0)
         self.guardian_status = 1
         self.raw = json.dumps(user_json)
+        self.uploader = uploader
+
+    def row(self) -> dict:
+        """转换为批量写入用的列字典"""
+        return {column.key: getattr(self, column.key) for column in Comment.__table__.columns}
+
+
+# 批量写入评论时每条语句包含的行数，需低于数据库的参数个数上限
+UPSERT_CHUNK_SIZE = 500
+# 重复抓取到已有评论时刷新的字段
+COMMENT_REFRESH_COLUMNS = ('like', 'rcount', 'mname')
+
+
+# 评论守护状态
+STATUS_FLAGGED = 2
+STATUS_DELETED = -1
+STATUS_MODERATION_FAILED = 3  # 自动删除失败
+DELETABLE_STATUSES = (0, 1)
+# 仪表盘计数：随写入增量维护的计数器名称
+STATUS_COUNTERS = {STATUS_FLAGGED: 'flagged_comments', STATUS_DELETED: 'deleted_comments'}
+TYPE_COUNTERS = {
+    CommentResourceType.VIDEO.value: 'video_comments',
+    CommentResourceType.DYNAMIC.value: 'dynamic_comments',
+    CommentResourceType.DYNAMIC_DRAW.value: 'dynamic_comments',
+}
+# 不同内容数的计数器及其包含的内容类型
+UNIQUE_OBJECT_COUNTERS = {
+    'unique_videos': [CommentResourceType.VIDEO.value],
+    'unique_dynamics': [CommentResourceType.DYNAMIC.value, CommentResourceType.DYNAMIC_DRAW.value],
+}
+STATISTIC_NAMES = ['total_comments', 'video_comments', 'dynamic_comments', 'flagged_comments', 'deleted_comments',
+                   'unique_videos', 'unique_dynamics', 'unique_users']
+
+
+class Statistic(db.Model):
+    """仪表盘计数的基数，写入评论和修改守护状态时的增减记在 statistic_delta 表，定期与 comment 表核对时合并"""
+    __tablename__ = 'statistic'
+    name = Column(Text, primary_key=True)
+    value = Column(Integer)
+
+    def __init__(self, name: str, value: int):
+        self.name = name
+        self.value = value
+
+
+class StatisticDelta(db.Model):
+    """计数器的增量，只追加不修改，读取时与 statistic 表相加，定期校正时合并"""
+    __tablename__ = 'statistic_delta'
+    id = Column(Integer, primary_key=True)
+    name = Column(Text)
+    delta = Column(Integer)
+
+
+def add_statistics(session, deltas: dict):
+    """在当前事务中追加计数器的增量，不更新共用的计数行，并发写入的进程不会互相等待行锁"""
+    rows = [{'name': name, 'delta': delta} for name, delta in sorted(deltas.items()) if delta]
+    if rows:
+        session.execute(StatisticDelta.__table__.insert(), rows)
+
+
+def read_statistics(session) -> dict:
+    values = dict(session.execute(select(Statistic.name, Statistic.value)).all())
+    deltas = dict(session.execute(
+        select(StatisticDelta.name, func.sum(StatisticDelta.delta)).group_by(StatisticDelta.name)
+    ).all())
+    return {name: (values.get(name) or 0) + int(deltas.get(name) or 0) for name in STATISTIC_NAMES}
+
+
+def compute_statistics(executor) -> dict:
+    """直接统计 comment 表得到各计数器的准确值，executor 可以是会话或连接"""
+    table = Comment.__table__
+
+    def count(*conditions) -> int:
+        return executor.execute(select(func.count()).select_from(table).where(*conditions)).scalar()
+
+    def count_distinct(column_, *conditions) -> int:
+        return executor.execute(select(func.count(func.distinct(column_))).where(*conditions)).scalar()
+
+    video_types = UNIQUE_OBJECT_COUNTERS['unique_videos']
+    dynamic_types = UNIQUE_OBJECT_COUNTERS['unique_dynamics']
+    return {
+        'total_comments': count(),
+        'video_comments': count(table.c.type_.in_(video_types)),
+        'dynamic_comments': count(table.c.type_.in_(dynamic_types)),
+        'flagged_comments': count(table.c.guardian_status == STATUS_FLAGGED),
+        'deleted_comments': count(table.c.guardian_status == STATUS_DELETED),
+        'unique_videos': count_distinct(table.c.oid, table.c.type_.in_(video_types)),
+        'unique_dynamics': count_distinct(table.c.oid, table.c.type_.in_(dynamic_types)),
+        'unique_users': count_distinct(table.c.mid),
+    }
+
+
+def reconcile_statistics(session):
+    """重新统计并覆盖计数器，修正增量维护中积累的偏差，同时清除已计入的增量"""
+    # 先记下已有的增量，重新统计时它们对应的评论已经写入；之后追加的增量保留到下次合并
+    merged = session.execute(select(func.max(StatisticDelta.id))).scalar()
+    current = read_statistics(session)
+    for name, value in compute_statistics(session).items():
+        if current[name] != value:
+            print(f"校正统计 {name}：{current[name]} -> {value}")
+        session.merge(Statistic(name, value))
+    if merged is not None:
+        session.execute(StatisticDelta.__table__.delete().where(StatisticDelta.id <= merged))
+
+
+def count_new_comments(session, rows: list) -> Counter:
+    """统计即将插入的新评论对各计数器的增量，需在插入之前调用"""
+    table = Comment.__table__
+    deltas = Counter(total_comments=len(rows))
+    for row in rows:
+        if row['type_'] in TYPE_COUNTERS:
+            deltas[TYPE_COUNTERS[row['type_']]] += 1
+        if row['guardian_status'] in STATUS_COUNTERS:
+            deltas[STATUS_COUNTERS[row['guardian_status']]] += 1
+    mids = {row['mid'] for row in rows}
+    if mids:
+        known = set(session.execute(select(table.c.mid).where(table.c.mid.in_(mids)).distinct()).scalars())
+        deltas['unique_users'] += len(mids - known)
+    for name, types in UNIQUE_OBJECT_COUNTERS.items():
+        oids = {row['oid'] for row in rows if row['type_'] in types}
+        if oids:
+            known = set(session.execute(
+                select(table.c.oid).where(table.c.oid.in_(oids), table.c.type_.in_(types)).distinct()
+            ).scalars())
+            deltas[name] += len(oids - known)
+    return deltas
+
+
+# 用户信誉表中按守护状态计数的列
+REPUTATION_STATUS_COLUMNS = {STATUS_FLAGGED: 'flagged_count', STATUS_DELETED: 'deleted_count'}
+
+
+class UserReputation(db.Model):
+    """每个评论用户的累计情况，写入评论和修改守护状态时同步更新，/bad_users 按删除数排序读取"""
+    __tablename__ = 'user_reputation'
+    __table_args__ = (
+        Index('ix_user_reputation_deleted', 'deleted_count', 'last_seen'),
+    )
+    mid = Column(BigId, primary_key=True)  # 用户 ID
+    deleted_count = Column(Integer)  # 被删除的评论数
+    flagged_count = Column(Integer)  # 已标记待删除的评论数
+    total_comments = Column(Integer)  # 抓取到的评论总数
+    last_seen = Column(DateTime)  # 最近一条评论的发布时间
+    last_name = Column(Text)  # 最近一条评论时的昵称
+
+
+def add_reputation_comments(session, rows: list):
+    """把即将插入的新评论计入发布者的信誉记录"""
+    table = UserReputation.__table__
+    latest = {}
+    totals = Counter()
+    for row in rows:
+        totals[row['mid']] += 1
+        if row['mid'] not in latest or row['ctime'] > latest[row['mid']]['ctime']:
+            latest[row['mid']] = row
+    if not totals:
+        return
+    users = [{
+        'mid': mid,
+        'deleted_count': 0,
+        'flagged_count': 0,
+        'total_comments': totals[mid],
+        'last_seen': latest[mid]['ctime'],
+        'last_name': latest[mid]['mname'],
+    } for mid in sorted(totals)]
+    dialect = db.engine.dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        # 一条 INSERT ... ON CONFLICT 语句完成，其他进程同时插入同一个新用户时不会违反主键约束
+        insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+        statement = insert(table).values(users)
+        excluded = statement.excluded
+        newer = or_(table.c.last_seen.is_(None), table.c.last_seen <= excluded.last_seen)
+        session.execute(statement.on_conflict_do_update(index_elements=[table.c.mid], set_={
+            'total_comments': table.c.total_comments + excluded.total_comments,
+            'last_name': case((newer, excluded.last_name), else_=table.c.last_name),
+            'last_seen': case((newer, excluded.last_seen), else_=table.c.last_seen),
+        }))
+        return
+    known = set(session.execute(select(table.c.mid).where(table.c.mid.in_(totals))).scalars())
+    new_users = [user for user in users if user['mid'] not in known]
+    if new_users:
+        session.execute(table.insert(), new_users)
+    updates = [{
+        'b_mid': user['mid'],
+        'b_total': user['total_comments'],
+        'b_seen': user['last_seen'],
+        'b_name': user['last_name'],
+    } for user in users if user['mid'] in known]
+    if updates:
+        newer = or_(table.c.last_seen.is_(None), table.c.last_seen <= bindparam('b_seen'))
+        session.execute(table.update().where(table.c.mid == bindparam('b_mid')).values(
+            total_comments=table.c.total_comments + bindparam('b_total'),
+            last_name=case((newer, bindparam('b_name')), else_=table.c.last_name),
+            last_seen=case((newer, bindparam('b_seen')), else_=table.c.last_seen),
+        ), updates)
+
+
+def add_reputation(session, users: dict):
+    """累加用户的删除数和标记数，users 为 {mid: {列名: 增量}}"""
+    table = UserReputation.__table__
+    updates = [{
+        'b_mid': mid,
+        'b_deleted': deltas.get('deleted_count', 0),
+        'b_flagged': deltas.get('flagged_count', 0),
+    } for mid, deltas in users.items() if any(deltas.values())]
+    if updates:
+        session.execute(table.update().where(table.c.mid == bindparam('b_mid')).values(
+            deleted_count=table.c.deleted_count + bindparam('b_deleted'),
+            flagged_count=table.c.flagged_count + bindparam('b_flagged'),
+        ), updates)
+
+
+def rebuild_reputation(executor):
+    """从 comment 表重新生成用户信誉表，executor 可以是会话或连接"""
+    table = UserReputation.__table__
+    per_user = select(
+        Comment.mid,
+        Comment.mname,
+        Comment.ctime,
+        func.count().over(partition_by=Comment.mid).label('total_comments'),
+        func.sum(case((Comment.guardian_status == STATUS_DELETED, 1), else_=0))
+        .over(partition_by=Comment.mid).label('deleted_count'),
+        func.sum(case((Comment.guardian_status == STATUS_FLAGGED, 1), else_=0))
+        .over(partition_by=Comment.mid).label('flagged_count'),
+        func.row_number().over(
+            partition_by=Comment.mid, order_by=(Comment.ctime.desc(), Comment.rpid.desc())
+        ).label('position')
+    ).subquery()
+    executor.execute(table.delete())
+    executor.execute(table.insert().from_select(
+        ['mid', 'deleted_count', 'flagged_count', 'total_comments', 'last_seen', 'last_name'],
+        select(per_user.c.mid, per_user.c.deleted_count, per_user.c.flagged_count, per_user.c.total_comments,
+               per_user.c.ctime, per_user.c.mname).where(per_user.c.position == 1)
+    ))
+
+
+def top_reputations(session, limit: Optional[int] = None) -> list:
+    """按被删除评论数从多到少读取用户信誉表，返回格式与 rank_bad_users 相同"""
+    return session.execute(
+        select(UserReputation.mid, UserReputation.last_name, UserReputation.last_seen, UserReputation.deleted_count)
+        .where(UserReputation.deleted_count > 0)
+        .order_by(UserReputation.deleted_count.desc(), UserReputation.last_seen.desc())
+        .limit(limit or BAD_USER_LIMIT)
+    ).all()
+
+
+class CounterChanges:
+    """一个事务中评论状态变化对统计计数和用户信誉的增量，最后统一写入"""
+
+    def __init__(self):
+        self.stats = Counter()
+        self.users = defaultdict(Counter)
+
+    def status_changed(self, mid: int, old_status: int, status: int, count: int = 1):
+        if old_status in STATUS_COUNTERS:
+            self.stats[STATUS_COUNTERS[old_status]] -= count
+            self.users[mid][REPUTATION_STATUS_COLUMNS[old_status]] -= count
+        if status in STATUS_COUNTERS:
+            self.stats[STATUS_COUNTERS[status]] += count
+            self.users[mid][REPUTATION_STATUS_COLUMNS[status]] += count
+
+    def apply(self, session):
+        add_statistics(session, self.stats)
+        add_reputation(session, self.users)
+
+
+def update_status(session, condition, status: int, changes: 'CounterChanges') -> int:
+    """把满足条件且状态不同的评论改为 status，计数的变化记入 changes，返回修改的行数"""
+    rows = session.execute(
+        select(Comment.mid, Comment.guardian_status, func.count())
+        .where(condition, Comment.guardian_status != status)
+        .group_by(Comment.mid, Comment.guardian_status)
+    ).all()
+    if not rows:
+        return 0
+    session.query(Comment).filter(condition, Comment.guardian_status != status). \
+        update({Comment.guardian_status: status}, synchronize_session=False)
+    for mid, old_status, count in rows:
+        changes.status_changed(mid, old_status, status, count)
+    return sum(count for _, _, count in rows)
+
+
+# flag_comments 对每个 rpid 的处理结果
+FLAG_FLAGGED = 'flagged'  # 已标记为删除
+FLAG_ALREADY = 'already'  # 已被删除或已标记过
+FLAG_NOT_FOUND = 'not_found'  # 数据库中没有这条评论
+
+
+def flag_comments(session, rpids: list) -> dict:
+    """把一批已在 B 站删除的评论标记为删除中，返回 {rpid: 处理结果}，由调用方提交"""
+    table = Comment.__table__
+    results = {}
+    changes = CounterChanges()
+    # 重复的 rpid 只处理一次，否则计数会按重复次数累加
+    rpids = list(dict.fromkeys(rpids))
+    for start in range(0, len(rpids), UPSERT_CHUNK_SIZE):
+        chunk = rpids[start:start + UPSERT_CHUNK_SIZE]
+        found = {rpid: (mid, status) for rpid, mid, status in session.execute(
+            select(table.c.rpid, table.c.mid, table.c.guardian_status).where(table.c.rpid.in_(chunk))
+        )}
+        deletable = [rpid for rpid, (_, status) in found.items() if status in DELETABLE_STATUSES]
+        for rpid in chunk:
+            if rpid not in found:
+                results[rpid] = FLAG_NOT_FOUND
+            elif rpid in deletable:
+                results[rpid] = FLAG_FLAGGED
+                changes.status_changed(found[rpid][0], found[rpid][1], STATUS_FLAGGED)
+            else:
+                results[rpid] = FLAG_ALREADY
+        if deletable:
+            session.execute(table.update().where(
+                table.c.rpid.in_(deletable), table.c.guardian_status.in_(DELETABLE_STATUSES)
+            ).values(guardian_status=STATUS_FLAGGED))
+    changes.apply(session)
+    return results
+
+
+def flagged_comments(session, limit: int) -> list:
+    """取出一批等待自动删除的评论 [(rpid, type_, oid)]"""
+    return session.execute(
+        select(Comment.rpid, Comment.type_, Comment.oid)
+        .where(Comment.guardian_status == STATUS_FLAGGED)
+        .order_by(Comment.rpid)
+        .limit(limit)
+    ).all()
+
+
+def finish_moderation(session, deleted: list, failed: list):
+    """写回自动删除的结果：已删除的标记为 -1，失败的标记为删除失败"""
+    changes = CounterChanges()
+    for rpids, status in ((deleted, STATUS_DELETED), (failed, STATUS_MODERATION_FAILED)):
+        if rpids:
+            update_status(session, and_(Comment.rpid.in_(rpids), Comment.guardian_status == STATUS_FLAGGED),
+                          status, changes)
+    changes.apply(session)
+
+
+def upsert_comments(session, comments: list) -> int:
+    """分块批量写入评论：新评论插入，已有评论刷新点赞数、回复数和昵称，返回新插入的评论数
+
+    SQLite 和 PostgreSQL 每块用一条 INSERT ... ON CONFLICT 语句完成，其他数据库退回批量插入加批量更新。
+    """
+    table = Comment.__table__
+    dialect = db.engine.dialect.name
+    new_count = 0
+    deltas = Counter()
+    for start in range(0, len(comments), UPSERT_CHUNK_SIZE):
+        rows = [comment_.row() for comment_ in comments[start:start + UPSERT_CHUNK_SIZE]]
+        existing = set(session.execute(
+            select(table.c.rpid).where(table.c.rpid.in_([row['rpid'] for row in rows]))
+        ).scalars())
+        new_count += len(rows) - len(existing)
+        new_rows = [row for row in rows if row['rpid'] not in existing]
+        deltas += count_new_comments(session, new_rows)
+        add_reputation_comments(session, new_rows)
+        if dialect in ('sqlite', 'postgresql'):
+            insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+            statement = insert(table).values(rows)
+            statement = statement.on_conflict_do_update(
+                index_elements=[table.c.rpid],
+                set_={column: statement.excluded[column] for column in COMMENT_REFRESH_COLUMNS}
+            )
+            session.execute(statement)
+        else:
+            session.bulk_insert_mappings(Comment, [row for row in rows if row['rpid'] not in existing])
+            session.bulk_update_mappings(Comment, [
+                {column: row[column] for column in ('rpid',) + COMMENT_REFRESH_COLUMNS}
+                for row in rows if row['rpid'] in existing
+            ])
+    add_statistics(session, deltas)
+    return new_count
+
+
+# 删除比对用的临时表：本次抓取到的评论 ID，scope 为 0 表示根评论列表，否则为子评论所属的根评论 ID
+visible_comment = table('visible_comment', column('scope', Integer), column('rpid', Integer))
+# 本次完整抓取了子评论的根评论 ID
+checked_root = table('checked_root', column('rpid', Integer))
+
+
+def load_visible_comments(session, all_rpid: set, sub_comments_dict: dict):
+    """把本次抓取到的评论 ID 写入当前连接的临时表，供集合化的删除比对使用"""
+    session.execute(text(
+        "CREATE TEMPORARY TABLE IF NOT EXISTS visible_comment "
+        "(scope BIGINT NOT NULL, rpid BIGINT NOT NULL, PRIMARY KEY (scope, rpid))"
+    ))
+    session.execute(text("CREATE TEMPORARY TABLE IF NOT EXISTS checked_root (rpid BIGINT PRIMARY KEY)"))
+    session.execute(visible_comment.delete())
+    session.execute(checked_root.delete())
+    rows = [{'scope': 0, 'rpid': rpid} for rpid in all_rpid]
+    for root, sub_comment_ids in sub_comments_dict.items():
+        rows += [{'scope': root, 'rpid': rpid} for rpid in set(sub_comment_ids)]
+    if rows:
+        session.execute(visible_comment.insert(), rows)
+    if sub_comments_dict:
+        session.execute(checked_root.insert(), [{'rpid': root} for root in sub_comments_dict])
+
+
+def mark_deleted_comments(session, oid: int, earliest_time: Optional[datetime], all_rpid: set,
+                          sub_comments_dict: dict) -> int:
+    """用几条集合化的 UPDATE 标记被删除和重新可见的评论，返回新发现的删除数
+
+    earliest_time 之后发布、但不在本次抓取结果中的根评论连同其子评论标记为删除；
+    sub_comments_dict 中的根评论下，不在本次子评论列表中的子评论标记为删除。
+    仍可见的评论恢复为可见状态，但自动删除失败的评论保持原状态；数据库启用了自动删除时已标记的评论也保持标记，等待自动删除。
+    """
+    if earliest_time is None and not sub_comments_dict:
+        return 0
+    load_visible_comments(session, all_rpid, sub_comments_dict)
+    changes = CounterChanges()
+    deleted_count = 0
+    if read_setting(session, MODERATION_SETTING):
+        kept = (STATUS_FLAGGED, STATUS_MODERATION_FAILED)
+    else:
+        kept = (STATUS_MODERATION_FAILED,)
+    reset = Comment.guardian_status.notin_(kept)
+
+    if earliest_time is not None:
+        later_root = and_(Comment.ctime >= earliest_time, Comment.oid == oid, Comment.root == 0)
+        root_visible = exists().where(and_(visible_comment.c.scope == 0, visible_comment.c.rpid == Comment.rpid))
+        deleted_roots = select(Comment.rpid).where(later_root, ~root_visible).scalar_subquery()
+        update_status(session, Comment.root.in_(deleted_roots), STATUS_DELETED, changes)
+        deleted_count += update_status(session, and_(later_root, ~root_visible), STATUS_DELETED, changes)
+        update_status(session, and_(later_root, root_visible, reset), 1, changes)
+
+    if sub_comments_dict:
+        checked = Comment.root.in_(select(checked_root.c.rpid).scalar_subquery())
+        sub_visible = exists().where(and_(
+            visible_comment.c.scope == Comment.root, visible_comment.c.rpid == Comment.rpid
+        ))
+        deleted_count += update_status(session, and_(checked, ~sub_visible), STATUS_DELETED, changes)
+        update_status(session, and_(checked, sub_visible, reset), 1, changes)
+
+    changes.apply(session)
+    return deleted_count
+
+
+# 每个对象保留的可见性快照数
+SNAPSHOT_HISTORY = 4
+# 评论事件类型
+EVENT_APPEARED = 'appeared'
+EVENT_VANISHED = 'vanished'
+EVENT_REAPPEARED = 'reappeared'
+
+
+def pack_rpids(rpids) -> bytes:
+    """把评论 ID 集合压缩为有序的 64 位整数数组"""
+    return array('q', sorted(rpids)).tobytes()
+
+
+def unpack_rpids(data: Optional[bytes]) -> set:
+    rpids = array('q')
+    if data:
+        rpids.frombytes(data)
+    return set(rpids)
+
+
+class VisibilitySnapshot(db.Model):
+    """对象在一次抓取后的可见评论集合，相邻两次快照求差得到评论事件"""
+    __tablename__ = 'visibility_snapshot'
+    oid = Column(BigId, primary_key=True)  # 内容 ID
+    type_ = Column(Integer, primary_key=True)  # 内容类型
+    taken = Column(DateTime, primary_key=True)  # 快照时间
+    visible = Column(LargeBinary)  # 已知可见的评论 ID
+    vanished = Column(LargeBinary)  # 已知消失的评论 ID
+
+    def __init__(self, oid: int, type_: int, taken: datetime, visible: set, vanished: set):
+        self.oid = oid
+        self.type_ = type_
+        self.taken = taken
+        self.visible = pack_rpids(visible)
+        self.vanished = pack_rpids(vanished)
+
+
+class CommentEvent(db.Model):
+    """只追加的评论可见性变化记录"""
+    __tablename__ = 'comment_event'
+    __table_args__ = (
+        Index('ix_comment_event_rpid_time', 'rpid', 'time'),
+        Index('ix_comment_event_object_time', 'oid', 'type_', 'time'),
+    )
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    rpid = Column(BigId)  # 回复 ID
+    oid = Column(BigId)  # 回复内容 ID
+    type_ = Column(Integer)  # 回复内容类型
+    event = Column(Text)  # appeared / vanished / reappeared
+    time = Column(DateTime)  # 发现变化的抓取时间
+
+
+def record_visibility(session, oid: int, type_: int, earliest_time: Optional[datetime], all_rpid: set,
+                      sub_comments_dict: dict, taken: datetime) -> int:
+    """与上一次快照比对，写入新快照和评论事件，返回本次消失的评论数
+
+    需在 mark_deleted_comments 之后于同一事务中调用，以复用其中的 checked_root 临时表。
+    只有本次抓取覆盖到的评论（earliest_time 之后的根评论和完整抓取了子评论的根评论下的子评论）缺席时才记为消失。
+    """
+    visible_now = set(all_rpid)
+    for sub_comment_ids in sub_comments_dict.values():
+        visible_now.update(sub_comment_ids)
+
+    previous = session.query(VisibilitySnapshot). \
+        filter_by(oid=oid, type_=type_). \
+        order_by(VisibilitySnapshot.taken.desc()).first()
+    prev_visible = unpack_rpids(previous.visible) if previous else set()
+    prev_vanished = unpack_rpids(previous.vanished) if previous else set()
+
+    missing = prev_visible - visible_now
+    vanished = set()
+    if missing and (earliest_time is not None or sub_comments_dict):
+        scope = []
+        if earliest_time is not None:
+            scope.append(and_(Comment.root == 0, Comment.ctime >= earliest_time))
+        if sub_comments_dict:
+            scope.append(Comment.root.in_(select(checked_root.c.rpid).scalar_subquery()))
+        covered = set(session.execute(
+            select(Comment.rpid).where(Comment.oid == oid, or_(*scope))
+        ).scalars())
+        vanished = missing & covered
+
+    appeared = visible_now - prev_visible
+    reappeared = appeared & prev_vanished
+    appeared -= reappeared
+
+    events = [(rpid, EVENT_APPEARED) for rpid in appeared]
+    events += [(rpid, EVENT_REAPPEARED) for rpid in reappeared]
+    events += [(rpid, EVENT_VANISHED) for rpid in vanished]
+    if events:
+        session.execute(CommentEvent.__table__.insert(), [
+            {'rpid': rpid, 'oid': oid, 'type_': type_, 'event': event, 'time': taken}
+            for rpid, event in events
+        ])
+
+    session.add(VisibilitySnapshot(
+        oid, type_, taken,
+        (prev_visible - vanished) | visible_now,
+        (prev_vanished - reappeared) | vanished
+    ))
+    session.flush()
+    # 只保留最近的几份快照
+    cutoff = session.query(VisibilitySnapshot.taken). \
+        filter_by(oid=oid, type_=type_). \
+        order_by(VisibilitySnapshot.taken.desc()). \
+        offset(SNAPSHOT_HISTORY - 1).limit(1).scalar()
+    if cutoff is not None:
+        session.query(VisibilitySnapshot). \
+            filter(VisibilitySnapshot.oid == oid, VisibilitySnapshot.type_ == type_,
+                   VisibilitySnapshot.taken < cutoff). \
+            delete(synchronize_session=False)
+    return len(vanished)
+
+
+# /bad_users 显示的用户数上限
+BAD_USER_LIMIT = 500
+
+
+def rank_bad_users(session, uploader: Optional[int] = None, limit: int = BAD_USER_LIMIT) -> list:
+    """按被删除评论数从多到少列出用户，返回 [(mid, 最近一条被删评论时的昵称, 最近被删评论的发布时间, 删除数)]
+
+    用一条带窗口函数的查询在数据库中完成分组、排序和截取，不把被删除的评论载入内存。
+    """
+    conditions = [Comment.guardian_status == STATUS_DELETED]
+    if uploader is not None:
+        conditions.append(Comment.uploader == uploader)
+    deleted = select(
+        Comment.mid,
+        Comment.mname,
+        Comment.ctime,
+        func.count().over(partition_by=Comment.mid).label('count'),
+        func.row_number().over(
+            partition_by=Comment.mid, order_by=(Comment.ctime.desc(), Comment.rpid.desc())
+        ).label('position')
+    ).where(*conditions).subquery()
+    return session.execute(
+        select(deleted.c.mid, deleted.c.mname, deleted.c.ctime, deleted.c.count)
+        .where(deleted.c.position == 1)
+        .order_by(deleted.c.count.desc(), deleted.c.ctime.desc())
+        .limit(limit)
+    ).all()
+
+
+def deletable_comments(session, mids: list, *conditions) -> dict:
+    """一次查询取出这些用户仍可删除的全部评论，返回 {mid: [(type_, oid, rpid)]}，每人按发布时间从新到旧排列"""
+    if not mids:
+        return {}
+    comments = {mid: [] for mid in mids}
+    for mid, type_, oid, rpid in session.execute(
+            select(Comment.mid, Comment.type_, Comment.oid, Comment.rpid)
+            .where(Comment.mid.in_(mids), Comment.guardian_status.in_(DELETABLE_STATUSES), *conditions)
+            .order_by(Comment.mid, Comment.ctime.desc(), Comment.rpid.desc())
+    ):
+        comments[mid].append((type_, oid, rpid))
+    return comments
+
+
+class ScrapeState(db.Model):
+    __tablename__ = 'scrape_state'
+    oid = Column(BigId, primary_key=True)  # 内容 ID
+    type_ = Column(Integer, primary_key=True)  # 内容类型
+    newest_ctime = Column(DateTime)  # 已抓取的最新根评论发布时间
+    newest_rpid = Column(BigId)  # 已抓取的最新根评论 ID
+    last_full_scan = Column(DateTime)  # 上次完整抓取时间
+    uploader_filled = Column(Boolean)  # 是否已补全升级前抓取的评论所属的 UP 主
+
+    def __init__(self, oid: int, type_: int):
+        self.oid = oid
+        self.type_ = type_
+
+    def watermark(self) -> Optional[tuple]:
+        if self.newest_ctime is None:
+            return None
+        return self.newest_ctime, self.newest_rpid or 0
+
+    def advance(self, comments: dict):
+        """用本次按时间抓取到的根评论推进水位线"""
+        roots = [
+            (datetime.utcfromtimestamp(comment_['ctime']), comment_['rpid'])
+            for comment_ in comments.values() if comment_.get('root', 0) == 0
+        ]
+        if not roots:
+            return
+        newest = max(roots)
+        current = self.watermark()
+        if current is None or newest > current:
+            self.newest_ctime, self.newest_rpid = newest
+
+
+# 在此之前发布的内容视为旧内容，/bad_users 只批量删除旧内容下的评论
+DISPLAY_BEFORE_TIMESTAMP = 1636611395
+
+
+class Content(db.Model):
+    __tablename__ = 'content'
+    __table_args__ = (
+        Index('ix_content_mid_new', 'mid', 'is_new'),
+    )
+    oid = Column(BigId, primary_key=True)  # 内容 ID
+    type_ = Column(Integer, primary_key=True)  # 内容类型
+    mid = Column(BigId)  # UP 主 ID
+    title = Column(Text)  # 标题或动态描述
+    pubtime = Column(DateTime)  # 发布时间
+    is_new = Column(Boolean)  # 是否为新内容，写入时按发布时间算出
+
+    def __init__(self, oid: int, type_: int, mid: int, title: str, pubtime: int):
+        self.oid = oid
+        self.type_ = type_
+        self.mid = mid
+        self.title = title
+        self.pubtime = datetime.utcfromtimestamp(pubtime)
+        self.is_new = pubtime > DISPLAY_BEFORE_TIMESTAMP
+
+    def is_video(self) -> bool:
+        return self.type_ == CommentResourceType.VIDEO.value
+
+
+def on_new_content():
+    """评论所属的内容是否为新内容，与 content 表关联判断"""
+    return exists().where(Content.oid == Comment.oid, Content.type_ == Comment.type_, Content.is_new)
+
+
+class Uploader(db.Model):
+    """监控中的 UP 主，保存昵称供页面导航使用，不必等抓取进程重新获取用户信息"""
+    __tablename__ = 'uploader'
+    mid = Column(BigId, primary_key=True)  # UP 主 ID
+    name = Column(Text)  # 昵称
+
+    def __init__(self, mid: int, name: str):
+        self.mid = mid
+        self.name = name
+
+
+def load_uploader_names(session, mids: list) -> dict:
+    """读取已保存的 UP 主昵称 {mid: 昵称}"""
+    if not mids:
+        return {}
+    return dict(session.execute(select(Uploader.mid, Uploader.name).where(Uploader.mid.in_(mids))).all())
+
+
+# 租约表中代表“刷新 UP 主内容列表”任务的类型，此时 oid 为 UP 主 ID
+CONTENT_LIST_TYPE = 0
+# 代表“自动删除已标记评论”任务的类型，整个数据库只有一行，保证同一时间只有一个抓取进程在删除评论
+MODERATION_TYPE = -1
+
+
+class ScrapeLease(db.Model):
+    """多个抓取进程共享的任务表，进程通过条件更新领取到期且没有有效租约的对象"""
+    __tablename__ = 'scrape_lease'
+    oid = Column(BigId, primary_key=True)  # 内容 ID，内容列表任务为 UP 主 ID
+    type_ = Column(Integer, primary_key=True)  # 内容类型
+    uploader = Column(BigId)  # 所属 UP 主 ID
+    oname = Column(Text)  # 内容标题
+    next_due = Column(DateTime)  # 下次到期时间
+    interval = Column(Float)  # 当前轮询间隔（秒）
+    velocity = Column(Float)  # 评论变化速度（每秒）
+    last_polled = Column(DateTime)  # 上次抓取完成时间
+    worker = Column(Text)  # 持有租约的抓取进程
+    lease_expires = Column(DateTime)  # 租约过期时间，超时未续约的任务可被其他进程领取
+
+    def __init__(self, oid: int, type_: int, uploader: int, oname: str, interval: float):
+        self.oid = oid
+        self.type_ = type_
+        self.uploader = uploader
+        self.oname = oname
+        self.interval = interval
+        self.next_due = datetime.utcnow()
+
+    def is_content_list(self) -> bool:
+        return self.type_ == CONTENT_LIST_TYPE
+
+    def is_moderation(self) -> bool:
+        return self.type_ == MODERATION_TYPE
+
+
+class Setting(db.Model):
+    """所有进程共用的设置，保存在数据库中"""
+    __tablename__ = 'setting'
+    name = Column(Text, primary_key=True)
+    value = Column(Integer)
+
+
+# 为 1 时已标记的评论由抓取进程自动删除，任何进程重新抓取时都保持标记
+MODERATION_SETTING = 'moderation'
+
+
+def read_setting(session, name: str, default: int = 0) -> int:
+    value = session.execute(select(Setting.value).where(Setting.name == name)).scalar()
+    return default if value is None else value
+
+
+def write_setting(session, name: str, value: int):
+    session.merge(Setting(name=name, value=value))
+
+
+class SchemaVersion(db.Model):
+    """记录数据库已执行到第几个迁移步骤"""
+    __tablename__ = 'schema_version'
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer)
+
+
+def add_uploader_column(connection):
+    columns = {column['name'] for column in inspect(connection).get_columns('comment')}
+    if 'uploader' not in columns:
+        print("升级数据库：comment 表新增 uploader 列")
+        connection.execute(text("ALTER TABLE comment ADD COLUMN uploader BIGINT"))
+        connection.execute(text(
+            "UPDATE comment SET uploader = "
+            "(SELECT content.mid FROM content WHERE content.oid = comment.oid AND content.type_ = comment.type_)"
+        ))
+
+
+def add_comment_indexes(connection):
+    print("升级数据库：为 comment 表创建索引")
+    for index in Comment.__table__.indexes:
+        index.create(connection, checkfirst=True)
+
+
+def add_partial_comment_indexes(connection):
+    print("升级数据库：为 comment 表创建部分索引")
+    for index in Comment.__table__.indexes:
+        if index.name in ('ix_comment_deleted_mid', 'ix_comment_visible_mid'):
+            index.create(connection, checkfirst=True)
+
+
+def fill_statistics(connection):
+    print("升级数据库：初始化统计计数")
+    table = Statistic.__table__
+    connection.execute(table.delete())
+    connection.execute(StatisticDelta.__table__.delete())
+    connection.execute(table.insert(), [
+        {'name': name, 'value': value} for name, value in compute_statistics(connection).items()
+    ])
+
+
+def add_content_is_new_column(connection):
+    columns = {column['name'] for column in inspect(connection).get_columns('content')}
+    if 'is_new' not in columns:
+        print("升级数据库：content 表新增 is_new 列")
+        connection.execute(text("ALTER TABLE content ADD COLUMN is_new BOOLEAN"))
+        table = Content.__table__
+        connection.execute(table.update().values(
+            is_new=table.c.pubtime > datetime.utcfromtimestamp(DISPLAY_BEFORE_TIMESTAMP)
+        ))
+    for index in Content.__table__.indexes:
+        index.create(connection, checkfirst=True)
+
+
+def add_scrape_state_uploader_filled_column(connection):
+    columns = {column['name'] for column in inspect(connection).get_columns('scrape_state')}
+    if 'uploader_filled' not in columns:
+        print("升级数据库：scrape_state 表新增 uploader_filled 列")
+        connection.execute(text("ALTER TABLE scrape_state ADD COLUMN uploader_filled BOOLEAN"))
+
+
+def fill_reputation(connection):
+    print("升级数据库：生成用户信誉表")
+    rebuild_reputation(connection)
+
+
+# 按顺序执行的迁移步骤，只能在末尾追加；每一步都需要能在已是新结构的数据库上重复执行
+MIGRATIONS = [
+    add_uploader_column,
+    add_comment_indexes,
+    add_partial_comment_indexes,
+    fill_statistics,
+    add_content_is_new_column,
+    fill_reputation,
+    add_scrape_state_uploader_filled_column,
+]
+
+
+# 串行执行建表和迁移的 PostgreSQL 咨询锁编号
+SCHEMA_LOCK_ID = 0x6775617264
+
+
+def lock_schema(connection):
+    """在当前事务中取得建表和迁移用的锁，事务结束时释放"""
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        connection.execute(select(func.pg_advisory_xact_lock(SCHEMA_LOCK_ID)))
+    elif dialect == 'sqlite':
+        # 立即取得写锁，其他进程的迁移在 busy_timeout 内等待
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+def upgrade_schema():
+    """建表并执行尚未执行过的迁移步骤，create_all 只会创建缺少的表，不会修改已存在的表
+
+    多个进程同时启动时，建表和迁移在同一个持锁的事务中串行执行，取得锁之后才读取版本号，
+    后取得锁的进程看到的是已经升级完成的结构。
+    """
+    # SQLite 只有一个写连接，会话占用的连接要先归还，迁移在单独取得的连接中进行
+    db.session.remove()
+    with db.engine.connect() as connection, connection.begin():
+        lock_schema(connection)
+        db.Model.metadata.create_all(connection)
+        version = connection.execute(select(SchemaVersion.version).where(SchemaVersion.id == 1)).scalar() or 0
+        for step, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            migration(connection)
+            if step == 1:
+                connection.execute(SchemaVersion.__table__.insert().values(id=1, version=step))
+            else:
+                connection.execute(SchemaVersion.__table__.update().values(version=step))
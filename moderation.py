@@ -0,0 +1,73 @@
+import asyncio
+import traceback
+from typing import Optional
+
+from bilibili_api import exceptions
+
+from circuit import CircuitOpenError, is_blocked
+from dataset import finish_moderation, flagged_comments
+
+# 表示评论已经不存在的错误代码，视为删除成功
+GONE_CODES = (-404, 12022)
+
+
+class ModerationExecutor:
+    """在抓取进程中自动删除已标记（guardian_status == 2）的评论
+
+    每轮从数据库取出一批已标记的评论，经过限速和熔断器并发调用删除接口，结果交给写入线程一次写回：
+    删除成功或评论已不存在的标记为已删除，接口明确拒绝的标记为删除失败，被风控或熔断的留到下一轮。
+    """
+
+    def __init__(self, scraper, batch_size: int = 20, interval: float = 30):
+        self.scraper = scraper
+        self.batch_size = batch_size
+        self.interval = interval  # 没有可处理的评论时的等待时间（秒）
+
+    async def delete(self, rpid: int, type_: int, oid: int) -> Optional[bool]:
+        """删除一条评论，返回 True 表示已删除，False 表示删除失败，None 表示暂时无法处理"""
+        try:
+            await self.scraper.delete_comment(oid, type_, rpid)
+        except CircuitOpenError:
+            return None
+        except exceptions.ResponseCodeException as e:
+            if e.code in GONE_CODES:
+                return True
+            if is_blocked(e):
+                return None
+            print(f"删除评论 {rpid} 失败：错误代码{e.code}")
+            return False
+        except Exception as e:
+            if is_blocked(e):
+                return None
+            print(f"删除评论 {rpid} 失败：{e}")
+            return None
+        return True
+
+    async def run_once(self) -> bool:
+        """处理一批已标记的评论，返回本轮是否有进展"""
+        writer = self.scraper.writer
+        session = self.scraper.db.session
+        batch = await writer.submit(flagged_comments, session, self.batch_size)
+        if not batch:
+            return False
+        results = await asyncio.gather(*[self.delete(rpid, type_, oid) for rpid, type_, oid in batch])
+        deleted = [row.rpid for row, result in zip(batch, results) if result is True]
+        failed = [row.rpid for row, result in zip(batch, results) if result is False]
+        if deleted or failed:
+            await writer.submit(finish_moderation, session, deleted, failed)
+            print(f"自动删除：成功 {len(deleted)} 条，失败 {len(failed)} 条")
+        return len(deleted) + len(failed) == len(batch)
+
+    async def drain(self):
+        """连续处理已标记的评论，直到没有可处理的评论或有评论暂时无法删除"""
+        while await self.run_once():
+            pass
+
+    async def run(self):
+        while True:
+            try:
+                await self.drain()
+            except Exception as err:
+                print(f"自动删除出错：{err}")
+                print(traceback.format_exc())
+            await asyncio.sleep(self.interval)
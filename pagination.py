@@ -0,0 +1,91 @@
+import calendar
+import math
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import and_, or_
+
+from dataset import Comment
+
+
+def encode_cursor(comment_: Comment) -> str:
+    """评论在 (ctime, rpid) 排序中的位置，形如 "发布时间戳-rpid" """
+    return f"{calendar.timegm(comment_.ctime.utctimetuple())}-{comment_.rpid}"
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[tuple]:
+    """解析 encode_cursor 生成的游标，无法解析时返回 None"""
+    if not cursor:
+        return None
+    try:
+        timestamp, rpid = cursor.split('-', 1)
+        return datetime.utcfromtimestamp(int(timestamp)), int(rpid)
+    except (ValueError, OverflowError):
+        return None
+
+
+def fetch_ordered(queries: list, ascending: bool, limit: int, offset: int = 0) -> list:
+    """按 (ctime, rpid) 排序取出几个查询合并后的第 offset 行起的 limit 行
+
+    每个查询单独按索引顺序取前 offset + limit 行再在内存中合并，数据库不需要为 IN 条件合并排序。
+    """
+    if ascending:
+        order = (Comment.ctime.asc(), Comment.rpid.asc())
+    else:
+        order = (Comment.ctime.desc(), Comment.rpid.desc())
+    if len(queries) == 1:
+        query = queries[0].order_by(*order)
+        if offset:
+            query = query.offset(offset)
+        return query.limit(limit).all()
+    rows = []
+    for query in queries:
+        rows += query.order_by(*order).limit(offset + limit).all()
+    rows.sort(key=lambda comment_: (comment_.ctime, comment_.rpid), reverse=not ascending)
+    return rows[offset:offset + limit]
+
+
+class KeysetPage:
+    """按 (ctime, rpid) 从新到旧排列的一页评论
+
+    翻页以上一页边界评论的位置为游标，只查询游标之后的 per_page + 1 行，不用 OFFSET 也不统计总数，
+    因此任意深度的翻页耗时相同。page 只用于显示，pages 为按估计总数算出的页数。
+    queries 中的每个查询（如动态和图文动态各一个）分别翻页后合并为一页。
+    """
+
+    def __init__(self, queries: list, per_page: int, after: Optional[str] = None, before: Optional[str] = None,
+                 page: int = 1, total: Optional[int] = None):
+        self.per_page = per_page
+        self.page = max(page, 1)
+        self.pages = max(math.ceil(total / per_page), 1) if total is not None else None
+
+        after_key = decode_cursor(after)
+        before_key = decode_cursor(before)
+        if before_key is not None:
+            # 向新的一端翻页：正序取游标之后的行再倒过来
+            ctime, rpid = before_key
+            newer = or_(Comment.ctime > ctime, and_(Comment.ctime == ctime, Comment.rpid > rpid))
+            rows = fetch_ordered([query.filter(newer) for query in queries], True, per_page + 1)
+            self.has_prev = len(rows) > per_page
+            self.has_next = True
+            self.items = list(reversed(rows[:per_page]))
+        else:
+            offset = 0
+            if after_key is not None:
+                ctime, rpid = after_key
+                older = or_(Comment.ctime < ctime, and_(Comment.ctime == ctime, Comment.rpid < rpid))
+                queries = [query.filter(older) for query in queries]
+            elif self.page > 1:
+                # 没有游标、直接跳转到指定页时才退回 OFFSET
+                offset = (self.page - 1) * per_page
+            rows = fetch_ordered(queries, False, per_page + 1, offset)
+            self.has_next = len(rows) > per_page
+            self.has_prev = after_key is not None or self.page > 1
+            self.items = rows[:per_page]
+
+        if not self.items:
+            self.has_next = False
+        self.next_cursor = encode_cursor(self.items[-1]) if self.items else None
+        self.prev_cursor = encode_cursor(self.items[0]) if self.items else None
+        self.next_num = self.page + 1
+        self.prev_num = self.page - 1
@@ -0,0 +1,58 @@
+import asyncio
+import time
+
+# 各接口类别的默认限速：(每秒请求数, 突发容量)
+DEFAULT_RATE_LIMITS = {
+    'comment': (3.0, 6),  # 主评论列表
+    'sub_comment': (2.0, 4),  # 子评论列表
+    'video_list': (1.0, 2),  # 用户信息和投稿视频列表
+    'dynamic_list': (1.0, 2),  # 动态列表
+    'moderation': (0.5, 2),  # 删除评论
+}
+
+
+class TokenBucket:
+    """令牌桶：以固定速率补充令牌，空闲时最多积累 burst 个"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        # 持锁等待，保证等待者按先来后到取得令牌
+        async with self.lock:
+            while True:
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    """所有对外请求共用的限速器，每类接口一个令牌桶"""
+
+    def __init__(self, limits: dict = None):
+        limits = {**DEFAULT_RATE_LIMITS, **(limits or {})}
+        self.buckets = {endpoint: TokenBucket(rate, burst) for endpoint, (rate, burst) in limits.items()}
+
+    async def acquire(self, endpoint: str):
+        await self.buckets[endpoint].acquire()
+
+
+def parse_rate_limit(value: str) -> tuple:
+    """解析命令行中的 endpoint=rate:burst"""
+    endpoint, limit = value.split('=', 1)
+    if endpoint not in DEFAULT_RATE_LIMITS:
+        raise ValueError(f"unknown endpoint {endpoint}")
+    rate, _, burst = limit.partition(':')
+    rate = float(rate)
+    return endpoint, (rate, int(burst) if burst else max(1, int(rate)))
@@ -0,0 +1,124 @@
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Optional
+
+
+def adapt_interval(interval: float, velocity: Optional[float], events: int, elapsed: float,
+                   min_interval: float, max_interval: float, target_events: float = 10,
+                   smoothing: float = 0.5) -> tuple:
+    """根据上次轮询以来的评论变化数估计速度，返回 (新的轮询间隔, 平滑后的速度)"""
+    current = events / max(elapsed, 1)
+    velocity = current if velocity is None else smoothing * current + (1 - smoothing) * velocity
+    desired = target_events / velocity if velocity > 0 else max_interval
+    # 变热时立即缩短间隔，变冷时每次最多翻倍
+    interval = min(desired, interval * 2)
+    return max(min_interval, min(max_interval, interval)), velocity
+
+
+class PollTarget:
+    """调度器中的一个抓取对象（视频或动态）"""
+
+    def __init__(self, oid: int, type_, oname: str, interval: float, group=None):
+        self.oid = oid
+        self.type_ = type_
+        self.oname = oname
+        self.group = group  # 所属 UP 主
+        self.interval = interval  # 当前轮询间隔（秒）
+        self.velocity: Optional[float] = None  # 每秒新增/删除评论数（指数平滑）
+        self.last_polled: Optional[float] = None
+        self.due = time.monotonic()
+        self.active = True
+
+    @property
+    def key(self) -> tuple:
+        return self.oid, self.type_
+
+    def __repr__(self):
+        return f"PollTarget({self.oid}, {self.type_}, interval={self.interval:.0f}s)"
+
+
+class PollScheduler:
+    """按下次到期时间排序的优先队列，评论变化快的对象轮询间隔短，冷门对象逐渐退避
+
+    每个分组（UP 主）一个堆，多个分组同时有到期对象时轮流取出，避免内容多的 UP 主占满抓取能力。
+    """
+
+    def __init__(self, min_interval: float, max_interval: float, target_events: float = 10, smoothing: float = 0.5):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_events = target_events  # 希望每次轮询平均看到的评论变化数
+        self.smoothing = smoothing
+        self.targets = {}
+        self.heaps = {}
+        self.served = {}  # 各分组上次被取出对象时的序号
+        self.counter = itertools.count()
+        self.changed = asyncio.Event()
+
+    def __len__(self):
+        return len(self.targets)
+
+    def push(self, target: PollTarget):
+        heapq.heappush(self.heaps.setdefault(target.group, []), (target.due, next(self.counter), target))
+        self.changed.set()
+
+    def sync(self, group, targets: dict):
+        """用某个分组最新的内容列表更新调度对象，targets 为 {(oid, type_): oname}"""
+        for key, oname in targets.items():
+            if key in self.targets:
+                self.targets[key].oname = oname
+            else:
+                # 新发现的对象立即抓取
+                target = PollTarget(key[0], key[1], oname, self.min_interval, group)
+                self.targets[key] = target
+                self.push(target)
+        for key, target in list(self.targets.items()):
+            if target.group == group and key not in targets:
+                # 已经不在最近列表中的对象不再调度，堆中的旧条目取出时丢弃
+                self.targets.pop(key).active = False
+
+    async def get(self) -> PollTarget:
+        """等待并取出下一个到期的对象，多个分组都有到期对象时取最久未被服务的分组"""
+        while True:
+            now = time.monotonic()
+            chosen = None
+            next_due = None
+            for group, heap in self.heaps.items():
+                while heap and not heap[0][2].active:
+                    heapq.heappop(heap)
+                if not heap:
+                    continue
+                if heap[0][0] <= now:
+                    if chosen is None or self.served.get(group, -1) < self.served.get(chosen, -1):
+                        chosen = group
+                elif next_due is None or heap[0][0] < next_due:
+                    next_due = heap[0][0]
+            if chosen is not None:
+                self.served[chosen] = next(self.counter)
+                return heapq.heappop(self.heaps[chosen])[2]
+            timeout = None if next_due is None else next_due - now
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(self.changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def done(self, target: PollTarget, events: int):
+        """根据本次观察到的评论变化数调整轮询间隔，并重新排队"""
+        now = time.monotonic()
+        if target.last_polled is not None:
+            target.interval, target.velocity = adapt_interval(
+                target.interval, target.velocity, events, now - target.last_polled,
+                self.min_interval, self.max_interval, self.target_events, self.smoothing
+            )
+        target.last_polled = now
+        target.due = now + target.interval
+        if target.active:
+            self.push(target)
+
+    def defer(self, target: PollTarget, delay: float):
+        """抓取失败时推迟重试，不影响轮询间隔的估计"""
+        target.due = time.monotonic() + delay
+        if target.active:
+            self.push(target)
@@ -1,4 +1,5 @@
 import asyncio
+import json
 import sys
 import threading
 import traceback
@@ -7,37 +8,109 @@ from queue import Queue
 from typing import Optional
 
 import aiohttp.client_exceptions
-import tqdm as tqdm
-from bilibili_api import user, comment, exceptions, video
+from bilibili_api import Credential, user, comment, exceptions, video
 from bilibili_api.comment import CommentResourceType, OrderType
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 
+from circuit import CircuitBreaker, CircuitOpenError, is_blocked
 from config import Config
-from dataset import Comment
-
-DISPLAY_BEFORE_TIMESTAMP = 1636611395
-
-async def retries(f, times=5):
+from credentials import CredentialPool
+from dataset import MODERATION_SETTING, Comment, Content, ScrapeState, Uploader, load_uploader_names, \
+    mark_deleted_comments, reconcile_statistics, record_visibility, upsert_comments, write_setting
+from moderation import ModerationExecutor
+from ratelimit import RateLimiter
+from scheduler import PollScheduler
+from writer import BatchWriter
+
+ENDPOINT_LABELS = {
+    'comment': "主评论",
+    'sub_comment': "子评论",
+    'video_list': "视频列表",
+    'dynamic_list': "动态列表",
+    'moderation': "删除评论",
+}
+
+async def retries(f, times=5, retry_codes=True):
+    """重试偶发的网络错误；接口被屏蔽和熔断交给熔断器处理，直接抛出
+
+    retry_codes 为 False 时接口返回的错误代码也直接抛出，用于错误代码是确定结果的接口（如删除评论）。
+    """
+    last_error = None
     for i in range(times):
         try:
-            await asyncio.sleep(1)
             return await f()
-        except aiohttp.client_exceptions.ServerDisconnectedError:
+        except aiohttp.client_exceptions.ServerDisconnectedError as e:
             print(f"服务器端开链接，重试第{i + 1}次...")
-        except asyncio.exceptions.TimeoutError:
+            last_error = e
+        except asyncio.exceptions.TimeoutError as e:
             print(f"服务器超时，重试第{i + 1}次...")
+            last_error = e
         except exceptions.ApiException as e:
-            if isinstance(e, exceptions.NetworkException):
-                print(f"接口被屏蔽，重试第{i + 1}次...")
-                await asyncio.sleep(120 * (2 ** i))
+            if is_blocked(e):
+                raise e
             elif isinstance(e, exceptions.ResponseCodeException):
-                if e.code == -404:
+                if e.code == -404 or not retry_codes:
                     raise e
                 else:
                     print(f"错误代码{e.code}，重试第{i + 1}次...")
             else:
                 print(f"API异常：{e}，重试第{i + 1}次...")
+            last_error = e
+    raise last_error
+
+
+def dynamic_oid(dynamic_: dict) -> int:
+    """Get the object ID for a dynamic based on its type"""
+    dynamic_type = dynamic_['desc']['type']
+    if dynamic_type == 2:  # Type 2 is a special case
+        return dynamic_['desc']['rid']
+    else:
+        return dynamic_['desc']['dynamic_id']
+
+
+def dynamic_card(dynamic_: dict) -> dict:
+    """Parse the card payload of a dynamic"""
+    card_data = dynamic_.get('card', {})
+    if isinstance(card_data, str):
+        try:
+            card_data = json.loads(card_data)
+        except ValueError:
+            card_data = {}
+    return card_data
+
+
+def dynamic_desc(dynamic_: dict) -> str:
+    """Get a readable description of a dynamic"""
+    dynamic_type = dynamic_['desc']['type']
+    
+    # Handle different dynamic types
+    if dynamic_type == 1:  # Repost
+        card_data = dynamic_card(dynamic_)
+        uname = "未知用户"
+        if 'origin_user' in card_data:
+            if isinstance(card_data['origin_user'], dict) and 'info' in card_data['origin_user']:
+                uname = card_data['origin_user']['info'].get('uname', "未知用户")
+                
+        content = card_data.get('item', {}).get('content', "")
+        return f"{content}：转发\"{uname}\""
+        
+    elif dynamic_type == 2:  # Image dynamic
+        return dynamic_card(dynamic_).get('item', {}).get('description', "")
+        
+    elif dynamic_type == 4:  # Text dynamic
+        return dynamic_card(dynamic_).get('item', {}).get('content', "")
+        
+    return f"动态 {dynamic_['desc'].get('dynamic_id', '')}"
+
+
+def dynamic_resource_type(dynamic_: dict) -> CommentResourceType:
+    """Determine the resource type of a dynamic for comment fetching"""
+    dynamic_type = dynamic_['desc']['type']
+    if dynamic_type == 2:
+        return CommentResourceType.DYNAMIC_DRAW
+    else:
+        return CommentResourceType.DYNAMIC
 
 
 class Scraper:
@@ -48,13 +121,41 @@ class Scraper:
         self.last_refreshed = None
         self.refresh_queue = Queue()
 
-        self.last_block: Optional[datetime] = None
-        self.wait_time = 0
-        self.wait_level = 0
-        self.first_trial = False
+        self.rate_limiter = RateLimiter(config.rate_limits)
+        self.credential_pool = CredentialPool(config.credentials, config.credential_park_time)
+        self.sub_comment_semaphore = asyncio.Semaphore(config.sub_comment_concurrency)
+        self.writer = BatchWriter(
+            app, db,
+            queue_size=config.write_queue_size,
+            batch_size=config.write_batch_size,
+            batch_delay=config.write_batch_delay
+        )
+
+        self.breakers = {
+            endpoint: CircuitBreaker(
+                endpoint,
+                ENDPOINT_LABELS.get(endpoint),
+                threshold=config.breaker_threshold,
+                base_delay=config.breaker_base_delay,
+                max_delay=config.breaker_max_delay
+            )
+            for endpoint in self.rate_limiter.buckets
+        }
+
+        # 自动删除已标记的评论，需要 UP 主本人的凭据
+        self.moderator = None
+        if config.moderation:
+            if config.uploader_credential is None:
+                # 凭据文件中的账号不一定是 UP 主本人，不能用来删除评论
+                print("未通过 --sessdata 和 --bili_jct 提供 UP 主凭据，自动删除评论未启用")
+            else:
+                self.moderator = ModerationExecutor(self, config.moderation_batch_size, config.moderation_interval)
 
-        self.new_video_oids = []
-        self.new_dynamic_oids = []
+        self.content_refreshes = {}  # 每个 UP 主距上次完整刷新内容列表的次数
+        self.uploader_names = {}
+
+        self.video_scheduler = PollScheduler(config.min_poll_interval, config.max_poll_interval)
+        self.dynamic_scheduler = PollScheduler(config.min_poll_interval, config.max_poll_interval)
         
         # 爬虫处理速率统计 - 改进版
         self.scraper_stats = {
@@ -85,77 +186,102 @@ class Scraper:
         # Keep only last 30 minutes of data
         self.recent_videos = [t for t in self.recent_videos if now - t < timedelta(minutes=30)]
 
-    async def allow_blocked(self, f):
-        current_time = datetime.now()
-        if self.last_block is None or current_time - self.last_block < timedelta(seconds=self.wait_time):
+    def limited(self, endpoint: str, f, credential: Optional[Credential] = None):
+        """包装 API 调用，每次实际发出请求前先经过对应接口的熔断器和令牌桶
+
+        f 接收本次请求使用的凭据。未指定 credential 时凭据从凭据池中轮换选取。
+        """
+        async def call():
+            breaker = self.breakers[endpoint]
+            probe = breaker.before_call()
             try:
-                await asyncio.sleep(1)
-                result = await f()
-                if self.first_trial:
-                    self.wait_level -= 1
-                    if self.wait_level < 0:
-                        self.wait_level = 0
-                self.first_trial = False
+                await self.rate_limiter.acquire(endpoint)
+                member = self.credential_pool.acquire() if credential is None else None
+                try:
+                    result = await f(member.credential if member is not None else credential)
+                except Exception as e:
+                    blocked = is_blocked(e)
+                    if member is not None:
+                        self.credential_pool.report_failure(member, blocked)
+                    if blocked:
+                        breaker.record_failure()
+                    raise
+                if member is not None:
+                    self.credential_pool.report_success(member)
+                breaker.record_success()
                 return result
-            except exceptions.NetworkException:
-                if self.first_trial:
-                    self.wait_level += 1
-                wait_time = 150 * (2 ** self.wait_level)
-                self.first_trial = True
-                self.last_block = current_time
-                print(f"接口被屏蔽，等待{wait_time}秒")
-                return None
-        else:
-            return None
-
-    async def scrap(self):
-        print("开始抓取")
-        
-        # 刷新统计记录，添加新的起始记录点
-        now = datetime.now()
-        self.comment_records.append((0, now))
-        self.video_records.append((0, now))
-        
-        # 清理旧记录
-        cutoff = now - timedelta(minutes=30)
-        self.comment_records = [r for r in self.comment_records if r[1] >= cutoff]
-        self.video_records = [r for r in self.video_records if r[1] >= cutoff]
-        
-        # Initialize tracking for current scrape session
-        if not hasattr(self, 'recent_comments'):
-            self.recent_comments = []
-        if not hasattr(self, 'recent_videos'):
-            self.recent_videos = []
-        
-        user_obj = user.User(self.config.user, credential=self.config.credential)
-
-        user_info = await retries(lambda: user_obj.get_user_info())
-        print(f"载入用户：{user_info['name']}")
-
-        # Get user videos
+            finally:
+                # 探测请求未得出结果（其他错误或被取消）时释放探测名额，否则熔断器会一直停在半开状态
+                if probe and breaker.probing:
+                    breaker.release()
+        return call
+
+    async def delete_comment(self, oid: int, type_: int, rpid: int):
+        """用 UP 主本人的凭据删除一条评论"""
+        return await retries(self.limited(
+            'moderation',
+            lambda credential: comment.Comment(
+                oid=oid,
+                type_=CommentResourceType(type_),
+                rpid=rpid,
+                credential=credential
+            ).delete(),
+            credential=self.config.uploader_credential
+        ), retry_codes=False)
+
+    @staticmethod
+    def user_obj(mid: int, credential: Optional[Credential]) -> user.User:
+        return user.User(mid, credential=credential)
+
+    def uploaders(self) -> list:
+        """监控中的 UP 主列表 [(mid, 昵称)]"""
+        missing = [mid for mid in self.config.users if mid not in self.uploader_names]
+        if missing:
+            # 昵称保存在 uploader 表中，重启后或不运行抓取时也能显示
+            self.uploader_names.update(load_uploader_names(self.db.session, missing))
+        return [(mid, self.uploader_names.get(mid, str(mid))) for mid in self.config.users]
+
+    def breaker_status(self) -> list:
+        return [breaker.status() for breaker in self.breakers.values()]
+
+    def credential_status(self) -> list:
+        return self.credential_pool.status()
+
+    def writer_status(self) -> dict:
+        return self.writer.status()
+
+    async def fetch_videos(self, mid: int, full: bool) -> list:
+        """抓取投稿视频列表，full 为 False 时只抓第一页"""
         videos_list = []
         page = 1
         while True:
-            video_pagination = await retries(lambda: user_obj.get_videos(pn=page))
+            video_pagination = await retries(self.limited(
+                'video_list', lambda credential: self.user_obj(mid, credential).get_videos(pn=page)
+            ))
             if not video_pagination['list']['vlist']:
                 break
             
             current_videos = video_pagination['list']['vlist']
-            filtered_current_videos = [v for v in current_videos if v['mid'] == self.config.user]
+            filtered_current_videos = [v for v in current_videos if v['mid'] == mid]
             videos_list.extend(filtered_current_videos)
             
-            if len(videos_list) >= self.config.video_count:
+            if not full or len(videos_list) >= self.config.video_count:
                 break
             page += 1
 
-        recent_videos = videos_list[:min(self.config.video_count, len(videos_list))]
-        self.new_video_oids = [v["aid"] for v in videos_list if v.get('created', 0) > DISPLAY_BEFORE_TIMESTAMP]
+        return [
+            Content(v['aid'], CommentResourceType.VIDEO.value, mid, v['title'], v.get('created', 0))
+            for v in videos_list
+        ]
 
-        # Get user dynamics
+    async def fetch_dynamics(self, mid: int, full: bool) -> list:
+        """抓取动态列表，full 为 False 时只抓第一页"""
         dynamics_list = []
         offset = 0
         while True:
-            dynamic_pagination = await retries(lambda: user_obj.get_dynamics(offset=offset))
+            dynamic_pagination = await retries(self.limited(
+                'dynamic_list', lambda credential: self.user_obj(mid, credential).get_dynamics(offset=offset)
+            ))
             if not dynamic_pagination.get('cards', []):
                 break
                 
@@ -167,317 +293,461 @@ class Scraper:
             ]
             dynamics_list.extend(filtered_dynamics)
             
-            if len(dynamics_list) >= self.config.dynamic_count:
+            if not full or len(dynamics_list) >= self.config.dynamic_count:
                 break
 
-        recent_dynamics = dynamics_list[:min(self.config.dynamic_count, len(dynamics_list))]
-
-        def dynamic_oid(dynamic_: dict) -> int:
-            """Get the object ID for a dynamic based on its type"""
-            dynamic_type = dynamic_['desc']['type']
-            if dynamic_type == 2:  # Type 2 is a special case
-                return dynamic_['desc']['rid']
-            else:
-                return dynamic_['desc']['dynamic_id']
-
-        self.new_dynamic_oids = [
-            dynamic_oid(d) for d in dynamics_list 
-            if d['desc'].get('timestamp', 0) > DISPLAY_BEFORE_TIMESTAMP
+        return [
+            Content(
+                dynamic_oid(d),
+                dynamic_resource_type(d).value,
+                mid,
+                dynamic_desc(d),
+                d['desc'].get('timestamp', 0)
+            )
+            for d in dynamics_list
         ]
 
-        async def get_comments(
-                oid: int,
-                type_: CommentResourceType,
-                max_page: int,
-                order: OrderType,
-                ignore_list: set = None
-        ) -> tuple:
-            """Fetch comments for a given resource"""
-            full_scrape = False
-            if ignore_list is None:
-                ignore_list = set()
-                
-            comments_dict = {}
-            sub_comments_dict = {}
+    def load_contents_cache(self, mid: int) -> tuple:
+        """读取 UP 主内容列表的缓存情况，返回 (是否已有缓存, 已保存的昵称)，在写入线程中执行"""
+        session = self.db.session
+        cached = session.query(Content.oid).filter(Content.mid == mid).first() is not None
+        return cached, load_uploader_names(session, [mid]).get(mid)
+
+    def store_contents(self, mid: int, contents: list, full: bool, name: Optional[str]) -> list:
+        """合并抓取到的内容列表并返回 UP 主的全部缓存内容（从新到旧），在写入线程中执行"""
+        session = self.db.session
+        cached = session.query(Content).filter(Content.mid == mid)
+        if full:
+            # 完整刷新时以最新列表为准，已删除的内容不再保留
+            cached.delete()
+        for content in contents:
+            session.merge(content)
+        if name is not None:
+            session.merge(Uploader(mid, name))
+        contents = cached.order_by(Content.pubtime.desc()).all()
+        # 交给事件循环使用，不随写入线程的提交过期
+        for content in contents:
+            session.expunge(content)
+        return contents
+
+    async def get_user_contents(self, mid: int) -> tuple:
+        """获取 UP 主最近的视频和动态列表
+
+        列表缓存在 content 表中，平时只抓第一页合并新内容，每隔若干次刷新才完整重新抓取一次。
+        缓存的读写交给写入线程执行，不阻塞事件循环。
+        """
+        cached, name = await self.writer.submit(self.load_contents_cache, mid)
+        refreshes = self.content_refreshes.get(mid, 0)
+        full = refreshes >= self.config.content_full_refresh_every or not cached
+        self.content_refreshes[mid] = 0 if full else refreshes + 1
+
+        if name is not None:
+            self.uploader_names[mid] = name
+        name = None
+        if full or mid not in self.uploader_names:
+            # 完整刷新时更新昵称，没有保存过昵称的 UP 主（如刚升级）在本进程首次刷新时获取
+            user_info = await retries(self.limited(
+                'video_list', lambda credential: self.user_obj(mid, credential).get_user_info()
+            ))
+            name = self.uploader_names[mid] = user_info['name']
+            print(f"载入用户：{user_info['name']}")
+
+        contents = await self.fetch_videos(mid, full)
+        contents += await self.fetch_dynamics(mid, full)
+        contents = await self.writer.submit(self.store_contents, mid, contents, full, name)
+
+        videos_list = [c for c in contents if c.is_video()]
+        dynamics_list = [c for c in contents if not c.is_video()]
+
+        return videos_list[:self.config.video_count], dynamics_list[:self.config.dynamic_count]
+
+    async def get_sub_comments(self, oid: int, type_: CommentResourceType, rpid: int) -> tuple:
+        """分页抓取一条根评论下的全部子评论，返回 (子评论列表, 是否抓取完整)"""
+        async with self.sub_comment_semaphore:
+            return await self.page_sub_comments(oid, type_, rpid)
+
+    async def page_sub_comments(self, oid: int, type_: CommentResourceType, rpid: int) -> tuple:
+        def sub_comments_page(credential: Optional[Credential], page_index: int):
+            comment_obj = comment.Comment(
+                oid=oid,
+                type_=type_,
+                rpid=rpid,
+                credential=credential
+            )
+            return comment_obj.get_sub_comments(page_index=page_index)
+
+        subs_list = []
+        page_index = 1
+        while True:
+            try:
+                sub_comments_result = await retries(self.limited(
+                    'sub_comment', lambda credential: sub_comments_page(credential, page_index)
+                ))
+            except CircuitOpenError as e:
+                # 熔断期间不再请求，本条根评论视为未抓全
+                print(f"跳过子评论：{e}")
+                return subs_list, False
+            except Exception as e:
+                print(f"获取子评论失败：{e}")
+                print(traceback.format_exc())
+                return subs_list, False
+
+            subs = sub_comments_result.get('replies', []) or []
+            if not subs:
+                return subs_list, True
+
+            subs_list.extend(subs)
+            page_index += 1
+
+    async def get_comments(
+            self,
+            oid: int,
+            type_: CommentResourceType,
+            max_page: int,
+            order: OrderType,
+            sub_comment_tasks: dict = None,
+            watermark: Optional[tuple] = None
+    ) -> tuple:
+        """Fetch comments for a given resource
+
+        sub_comment_tasks 在同一对象的多次抓取之间共享，同一根评论的子评论只请求一次。
+        watermark 为 (ctime, rpid)，按时间抓取时翻到越过水位线的那一页就停止。
+        """
+        full_scrape = False
+        if sub_comment_tasks is None:
+            sub_comment_tasks = {}
             
-            for i in range(max_page):
-                try:
-                    # Get main comments
-                    comments_result = await retries(
-                        lambda: comment.get_comments(
-                            oid=oid, 
-                            type_=type_,
-                            page_index=i + 1, 
-                            order=order,
-                            credential=self.config.credential
-                        )
+        comments_dict = {}
+        sub_comments_dict = {}
+        pending_roots = []  # 等待子评论阶段完成的根评论
+        
+        for i in range(max_page):
+            try:
+                # Get main comments
+                comments_result = await retries(self.limited(
+                    'comment', lambda credential: comment.get_comments(
+                        oid=oid, 
+                        type_=type_,
+                        page_index=i + 1, 
+                        order=order,
+                        credential=credential
                     )
-                except exceptions.ResponseCodeException as e:
-                    print(f"错误代码{e.code}，停止抓取")
-                    break
-                    
-                replies = comments_result.get('replies', []) or []
-                
-                # Process main comments
-                for comment_data in replies:
-                    if comment_data['rpid'] in ignore_list:
-                        continue
-                        
-                    comments_dict[comment_data['rpid']] = comment_data
-                    sub_comment_ids = []
-                    scraped_sub_comments = False
-                    
-                    # Process sub-comments if any
-                    if comment_data.get('replies'):
-                        if comment_data.get('rcount', 0) > len(comment_data['replies']):
-                            # Need to fetch more sub-comments
-                            # Create a Comment object for the specific resource
-                            from bilibili_api import comment as comment_module
-                            comment_obj = comment_module.Comment(
-                                oid=oid,
-                                type_=type_,
-                                rpid=comment_data['rpid'],
-                                credential=self.config.credential
-                            )
-                            
-                            page_index = 1
-                            while True:
-                                try:
-                                    sub_comments_result = await retries(
-                                        lambda: self.allow_blocked(
-                                            lambda: comment_obj.get_sub_comments(page_index=page_index)
-                                        )
-                                    )
-                                except Exception as e:
-                                    print(f"获取子评论失败：{e}")
-                                    print(traceback.format_exc())
-                                    sub_comments_result = None
-                                    
-                                if sub_comments_result is None:
-                                    sub_comment_ids = []
-                                    break
-                                    
-                                subs = sub_comments_result.get('replies', []) or []
-                                if not subs:
-                                    scraped_sub_comments = True
-                                    break
-                                    
-                                for sub in subs:
-                                    comments_dict[sub['rpid']] = sub
-                                    sub_comment_ids.append(sub['rpid'])
-                                    
-                                page_index += 1
-                        else:
-                            # All sub-comments are already included
-                            for sub in comment_data['replies']:
-                                comments_dict[sub['rpid']] = sub
-                                sub_comment_ids.append(sub['rpid'])
-                            scraped_sub_comments = True
-                            
-                    if scraped_sub_comments:
-                        sub_comments_dict[comment_data['rpid']] = sub_comment_ids
-
-                # If no more comments, we've done a full scrape
-                if not replies:
-                    full_scrape = True
-                    break
-                    
-            return comments_dict, sub_comments_dict, full_scrape
-
-        def update_comments(oname: str, oid: int, comments_time: dict, comments_like: dict, full_scrape=False):
-            """Update comment records in the database"""
-            if full_scrape:
-                db_comments = [Comment(comment_, oname) for comment_ in comments_time.values()]
-                db_comments += [Comment(comment_, oname) for comment_ in comments_like.values()]
-                min_list = [comment_.ctime for comment_ in db_comments if comment_.root == 0]
-                earliest_time = min(min_list) if min_list else None
-            else:
-                db_comments = [Comment(comment_, oname) for comment_ in comments_time.values()]
-                min_list = [comment_.ctime for comment_ in db_comments if comment_.root == 0]
-                earliest_time = min(min_list) if min_list else None
-                db_comments += [Comment(comment_, oname) for comment_ in comments_like.values()]
+                ))
+            except exceptions.ResponseCodeException as e:
+                if is_blocked(e):
+                    raise e
+                print(f"错误代码{e.code}，停止抓取")
+                break
                 
-            if earliest_time is not None:
-                later_comments = Comment.query.filter(
-                    Comment.ctime >= earliest_time,
-                    Comment.oid == oid,
-                    Comment.root == 0
-                ).all()
+            replies = comments_result.get('replies', []) or []
+            
+            # Process main comments
+            for comment_data in replies:
+                comments_dict[comment_data['rpid']] = comment_data
+                sub_comment_ids = []
+                scraped_sub_comments = False
                 
-                for later_comment in later_comments:
-                    if later_comment.rpid not in all_rpid:
-                        later_comment.guardian_status = -1
-                        sub_comments = Comment.query.filter(
-                            Comment.root == later_comment.rpid
-                        ).all()
-                        for comment_ in sub_comments:
-                            comment_.guardian_status = -1
-                    else:
-                        later_comment.guardian_status = 1
-
-            # Update sub-comments status
-            for sub_comment_rpid, sub_comment_ids in sub_comments_dict.items():
-                sub_comments = Comment.query.filter(
-                    Comment.root == sub_comment_rpid
-                ).all()
-                for sub_comment in sub_comments:
-                    if sub_comment.rpid not in sub_comment_ids:
-                        sub_comment.guardian_status = -1
+                # Process sub-comments if any
+                if comment_data.get('replies'):
+                    if comment_data.get('rcount', 0) > len(comment_data['replies']):
+                        # Need to fetch more sub-comments
+                        # 交给独立的子评论阶段并发抓取，主评论继续翻页
+                        rpid = comment_data['rpid']
+                        if rpid not in sub_comment_tasks:
+                            sub_comment_tasks[rpid] = asyncio.ensure_future(
+                                self.get_sub_comments(oid, type_, rpid)
+                            )
+                        pending_roots.append(rpid)
                     else:
-                        sub_comment.guardian_status = 1
+                        # All sub-comments are already included
+                        for sub in comment_data['replies']:
+                            comments_dict[sub['rpid']] = sub
+                            sub_comment_ids.append(sub['rpid'])
+                        scraped_sub_comments = True
+                        
+                if scraped_sub_comments:
+                    sub_comments_dict[comment_data['rpid']] = sub_comment_ids
 
-            # 确定新评论和重复评论
-            filtered_db_comments = [comment_ for comment_ in db_comments if Comment.query.get(comment_.rpid) is None]
-            duplicate_comments = len(db_comments) - len(filtered_db_comments)
-            
-            # 统计所有处理的评论数（新评论 + 重复评论）
-            total_processed = len(db_comments)
-            
-            # 更新爬虫统计数据 - 记录处理的所有评论数
-            if total_processed > 0:
-                print(f"处理 {total_processed} 条评论（{len(filtered_db_comments)} 条新评论，{duplicate_comments} 条重复评论）")
-                self.update_comment_rate(total_processed)  # 使用总处理数更新速率
-            
-            # 只保存新评论到数据库
-            self.db.session.bulk_save_objects(filtered_db_comments)
-            self.db.session.commit()
-
-        # Process videos and get comments
-        for video_data in tqdm.tqdm(recent_videos):
-            # 更新爬虫统计数据 - 记录处理的视频数
-            self.update_video_rate(1)
-            
-            # Track this video
-            self.track_new_video()
-            
-            # Get comments sorted by time
-            video_comments_time, video_sub_comments_time, full_scrape_time = await get_comments(
-                video_data["aid"],
-                type_=CommentResourceType.VIDEO,
-                max_page=self.config.max_page,
-                order=OrderType.TIME
-            )
-            
-            # Get comments sorted by likes
-            video_comments_likes, video_sub_comments_likes, full_scrape_like = await get_comments(
-                video_data["aid"],
-                type_=CommentResourceType.VIDEO,
-                max_page=self.config.max_page,
-                order=OrderType.LIKE,
-                ignore_list=set(video_comments_time.keys())
-            )
-            
-            all_rpid = set(video_comments_likes.keys()).union(video_comments_time.keys())
-            sub_comments_dict = dict(video_sub_comments_time)
-            sub_comments_dict.update(video_sub_comments_likes)
-
-            update_comments(
-                video_data['title'],
-                video_data['aid'],
-                video_comments_time,
-                video_comments_likes,
-                full_scrape_time and full_scrape_like
-            )
+            # If no more comments, we've done a full scrape
+            if not replies:
+                full_scrape = True
+                break
 
-        def dynamic_desc(dynamic_: dict) -> str:
-            """Get a readable description of a dynamic"""
-            dynamic_type = dynamic_['desc']['type']
-            
-            # Handle different dynamic types
-            if dynamic_type == 1:  # Repost
-                card_data = dynamic.get('card', {})
-                if isinstance(card_data, str):
-                    try:
-                        import json
-                        card_data = json.loads(card_data)
-                    except:
-                        card_data = {}
-                        
-                uname = "未知用户"
-                if 'origin_user' in card_data:
-                    if isinstance(card_data['origin_user'], dict) and 'info' in card_data['origin_user']:
-                        uname = card_data['origin_user']['info'].get('uname', "未知用户")
-                        
-                content = card_data.get('item', {}).get('content', "")
-                return f"{content}：转发\"{uname}\""
-                
-            elif dynamic_type == 2:  # Image dynamic
-                card_data = dynamic.get('card', {})
-                if isinstance(card_data, str):
-                    try:
-                        import json
-                        card_data = json.loads(card_data)
-                    except:
-                        card_data = {}
-                return card_data.get('item', {}).get('description', "")
-                
-            elif dynamic_type == 4:  # Text dynamic
-                card_data = dynamic.get('card', {})
-                if isinstance(card_data, str):
-                    try:
-                        import json
-                        card_data = json.loads(card_data)
-                    except:
-                        card_data = {}
-                return card_data.get('item', {}).get('content', "")
-                
-            return f"动态 {dynamic_['desc'].get('dynamic_id', '')}"
+            # 增量模式：本页已包含上次抓取过的评论，更早的页无需再翻
+            if watermark is not None and any(
+                    (datetime.utcfromtimestamp(comment_data['ctime']), comment_data['rpid']) <= watermark
+                    for comment_data in replies
+            ):
+                break
 
-        def dynamic_resource_type(dynamic_: dict) -> CommentResourceType:
-            """Determine the resource type of a dynamic for comment fetching"""
-            dynamic_type = dynamic_['desc']['type']
-            if dynamic_type == 2:
-                return CommentResourceType.DYNAMIC_DRAW
-            else:
-                return CommentResourceType.DYNAMIC
-
-        # Process dynamics and get comments
-        for dynamic_data in tqdm.tqdm(recent_dynamics):
-            # Get comments sorted by time
-            dynamic_comments_time, dynamic_sub_comments_time, full_scrape_time = await get_comments(
-                dynamic_oid(dynamic_data),
-                type_=dynamic_resource_type(dynamic_data),
-                max_page=self.config.max_page,
-                order=OrderType.TIME
-            )
-            
-            # Get comments sorted by likes
-            dynamic_comments_likes, dynamic_sub_comments_likes, full_scrape_like = await get_comments(
-                dynamic_oid(dynamic_data),
-                type_=dynamic_resource_type(dynamic_data),
+        # 只有全部分页都抓取成功的根评论才记入 sub_comments_dict
+        sub_results = await asyncio.gather(*[sub_comment_tasks[rpid] for rpid in pending_roots])
+        for rpid, (subs, scraped_sub_comments) in zip(pending_roots, sub_results):
+            for sub in subs:
+                comments_dict[sub['rpid']] = sub
+            if scraped_sub_comments:
+                sub_comments_dict[rpid] = [sub['rpid'] for sub in subs]
+                
+        return comments_dict, sub_comments_dict, full_scrape
+
+    def update_comments(
+            self,
+            oname: str,
+            oid: int,
+            type_: CommentResourceType,
+            uploader: int,
+            comments_time: dict,
+            comments_like: dict,
+            all_rpid: set,
+            sub_comments_dict: dict,
+            full_scrape=False
+    ) -> tuple:
+        """Update comment records in the database
+
+        在写入线程中执行，由写入线程统一提交。返回 (新评论数, 新发现的删除数)，供调度器估计对象的活跃程度。
+        """
+        if full_scrape:
+            db_comments = [Comment(comment_, oname, uploader) for comment_ in comments_time.values()]
+            db_comments += [Comment(comment_, oname, uploader) for comment_ in comments_like.values()]
+            min_list = [comment_.ctime for comment_ in db_comments if comment_.root == 0]
+            earliest_time = min(min_list) if min_list else None
+        else:
+            db_comments = [Comment(comment_, oname, uploader) for comment_ in comments_time.values()]
+            min_list = [comment_.ctime for comment_ in db_comments if comment_.root == 0]
+            earliest_time = min(min_list) if min_list else None
+            db_comments += [Comment(comment_, oname, uploader) for comment_ in comments_like.values()]
+
+
+        # 集合化比对删除状态，避免逐条加载评论
+        deleted_count = mark_deleted_comments(self.db.session, oid, earliest_time, all_rpid, sub_comments_dict)
+        # 与上次快照求差，记录评论出现、消失和重新出现的时间
+        record_visibility(
+            self.db.session, oid, type_.value, earliest_time, all_rpid, sub_comments_dict, datetime.utcnow()
+        )
+
+        # 批量写入：新评论插入，重复评论刷新点赞数等可变字段
+        unique_comments = list({comment_.rpid: comment_ for comment_ in db_comments}.values())
+        new_count = upsert_comments(self.db.session, unique_comments)
+        duplicate_comments = len(db_comments) - new_count
+        
+        # 统计所有处理的评论数（新评论 + 重复评论）
+        total_processed = len(db_comments)
+        
+        if total_processed > 0:
+            print(f"处理 {total_processed} 条评论（{new_count} 条新评论，{duplicate_comments} 条重复评论）")
+
+        return new_count, deleted_count
+
+    @staticmethod
+    def load_state(oid: int, type_: CommentResourceType) -> tuple:
+        """读取对象的抓取进度，返回 (水位线, 上次完整扫描时间)"""
+        state = ScrapeState.query.get((oid, type_.value))
+        if state is None:
+            return None, None
+        return state.watermark(), state.last_full_scan
+
+    def store_object(self, oname: str, oid: int, type_: CommentResourceType, uploader: int,
+                     comments_time: dict, comments_like: dict, all_rpid: set, sub_comments_dict: dict,
+                     full_scrape: bool, scan_time: Optional[datetime]) -> tuple:
+        """写入一个对象的抓取结果并推进其抓取进度，在写入线程中执行"""
+        counts = self.update_comments(
+            oname, oid, type_, uploader, comments_time, comments_like, all_rpid, sub_comments_dict, full_scrape
+        )
+        state = ScrapeState.query.get((oid, type_.value)) or ScrapeState(oid, type_.value)
+        if not state.uploader_filled:
+            # 每个对象只补全一次升级前抓取的评论所属的 UP 主
+            Comment.query.filter(Comment.oid == oid, Comment.type_ == type_.value, Comment.uploader.is_(None)). \
+                update({Comment.uploader: uploader}, synchronize_session=False)
+            state.uploader_filled = True
+        state.advance(comments_time)
+        if scan_time is not None:
+            state.last_full_scan = scan_time
+        self.db.session.add(state)
+        return counts
+
+    async def scrap_object(self, oid: int, type_: CommentResourceType, oname: str, uploader: int) -> tuple:
+        """抓取单个视频或动态的评论并写入数据库，返回 (新评论数, 新发现的删除数)
+
+        分为三个阶段：抓取（并发请求接口）、比对（合并两轮结果）、写入（交给写入线程批量提交）。
+        """
+        watermark, last_full_scan = await self.writer.submit(self.load_state, oid, type_)
+        scan_time = datetime.now()
+        # 增量模式下只翻到水位线为止，深层页面按较慢的校验周期完整重扫
+        full_scan = not self.config.incremental or last_full_scan is None or \
+            scan_time - last_full_scan >= timedelta(seconds=self.config.full_scan_interval)
+        if full_scan:
+            watermark = None
+        like_max_page = self.config.max_page if full_scan else 1
+
+        # 按时间和按热度排序的两轮抓取同时进行，共享子评论请求
+        sub_comment_tasks = {}
+        passes = [
+            asyncio.ensure_future(self.get_comments(
+                oid,
+                type_=type_,
                 max_page=self.config.max_page,
+                order=OrderType.TIME,
+                sub_comment_tasks=sub_comment_tasks,
+                watermark=watermark
+            )),
+            asyncio.ensure_future(self.get_comments(
+                oid,
+                type_=type_,
+                max_page=like_max_page,
                 order=OrderType.LIKE,
-                ignore_list=set(dynamic_comments_time.keys())
-            )
-            
-            all_rpid = set(dynamic_comments_likes.keys()).union(dynamic_comments_time.keys())
-            sub_comments_dict = dict(dynamic_sub_comments_time)
-            sub_comments_dict.update(dynamic_sub_comments_likes)
-
-            update_comments(
-                dynamic_desc(dynamic_data),
-                dynamic_oid(dynamic_data),
-                dynamic_comments_time,
-                dynamic_comments_likes,
-                full_scrape_like and full_scrape_time
-            )
+                sub_comment_tasks=sub_comment_tasks
+            )),
+        ]
+        try:
+            time_result, like_result = await asyncio.gather(*passes)
+        except Exception:
+            # 一轮失败时取消另一轮和尚未完成的子评论抓取
+            for task in passes + list(sub_comment_tasks.values()):
+                task.cancel()
+            raise
+        comments_time, sub_comments_time, full_scrape_time = time_result
+        comments_likes_all, sub_comments_likes_all, full_scrape_like = like_result
+
+        # 合并时去重：按热度的结果里跳过按时间已经抓到的根评论及其子评论
+        comments_likes = {
+            rpid: comment_ for rpid, comment_ in comments_likes_all.items()
+            if rpid not in comments_time and comment_.get('root', 0) not in comments_time
+        }
+        sub_comments_likes = {
+            rpid: sub_comment_ids for rpid, sub_comment_ids in sub_comments_likes_all.items()
+            if rpid not in comments_time
+        }
+
+        all_rpid = set(comments_likes.keys()).union(comments_time.keys())
+        sub_comments_dict = dict(sub_comments_time)
+        sub_comments_dict.update(sub_comments_likes)
+
+        counts = await self.writer.submit(
+            self.store_object,
+            oname,
+            oid,
+            type_,
+            uploader,
+            comments_time,
+            comments_likes,
+            all_rpid,
+            sub_comments_dict,
+            full_scrape_time and full_scrape_like,
+            scan_time if full_scan else None
+        )
+
+        # 更新爬虫统计数据 - 记录处理的所有评论数
+        total_processed = len(comments_time) + len(comments_likes)
+        if total_processed > 0:
+            self.update_comment_rate(total_processed)  # 使用总处理数更新速率
+
+        return counts
+
+    async def refresh_contents(self):
+        """刷新 UP 主的内容列表，并同步到调度器"""
+        print("刷新内容列表")
+
+        # 刷新统计记录，添加新的起始记录点
+        now = datetime.now()
+        self.comment_records.append((0, now))
+        self.video_records.append((0, now))
         
+        # 清理旧记录
+        cutoff = now - timedelta(minutes=30)
+        self.comment_records = [r for r in self.comment_records if r[1] >= cutoff]
+        self.video_records = [r for r in self.video_records if r[1] >= cutoff]
+
+        for mid in self.config.users:
+            try:
+                recent_videos, recent_dynamics = await self.get_user_contents(mid)
+            except Exception as err:
+                # 单个 UP 主刷新失败时保留其已有的调度对象
+                print(f"刷新 UP 主 {mid} 的内容列表失败：{err}")
+                print(traceback.format_exc())
+                continue
+
+            self.video_scheduler.sync(mid, {
+                (content.oid, CommentResourceType(content.type_)): content.title
+                for content in recent_videos
+            })
+            self.dynamic_scheduler.sync(mid, {
+                (content.oid, CommentResourceType(content.type_)): content.title
+                for content in recent_dynamics
+            })
+
         # 打印当前速率统计
         print(f"当前爬虫速率: {self.scraper_stats['comment_rate']}条评论/秒, {self.scraper_stats['video_rate']}个视频/分")
         print(f"最近30分钟记录: {len(self.comment_records)}条评论批次, {len(self.video_records)}条视频批次")
-        
-        self.last_refreshed = datetime.now()
+
+    async def poll_worker(self, scheduler: PollScheduler, is_video: bool):
+        """从调度器中取出到期的对象进行抓取，完成后按活跃程度重新排队"""
+        while True:
+            target = await scheduler.get()
+            try:
+                new_count, deleted_count = await self.scrap_object(
+                    target.oid, target.type_, target.oname, target.group
+                )
+                scheduler.done(target, new_count + deleted_count)
+                if is_video:
+                    self.update_video_rate(1)
+                    self.track_new_video()
+                self.last_refreshed = datetime.now()
+            except CircuitOpenError as err:
+                # 熔断时不等待，把对象推迟到熔断结束后，继续处理其他对象
+                print(f"推迟抓取 {target.oid}：{err}")
+                scheduler.defer(target, max(err.retry_in, self.config.min_poll_interval))
+            except Exception as err:
+                print(f"抓取 {target.oid} 失败：{err}")
+                print(traceback.format_exc())
+                scheduler.defer(target, target.interval)
+            finally:
+                sys.stdout.flush()
+
+    async def store_moderation_setting(self):
+        """把自动删除的开关写入数据库，所有进程重新抓取时据此决定是否保持已标记评论的状态
+
+        只有启用自动删除或指定了 --disable_moderation 的进程会修改设置，其他进程沿用数据库中的设置。
+        """
+        if self.moderator is not None:
+            enabled = 1
+        elif self.config.disable_moderation:
+            enabled = 0
+        else:
+            return
+        await self.writer.submit(write_setting, self.db.session, MODERATION_SETTING, enabled)
+
+    async def reconcile_loop(self):
+        """定期重新统计仪表盘计数，修正增量维护的偏差"""
+        while True:
+            await asyncio.sleep(self.config.stats_reconcile_interval)
+            try:
+                await self.writer.submit(reconcile_statistics, self.db.session)
+            except Exception as err:
+                print(f"校正统计失败：{err}")
+                print(traceback.format_exc())
 
     async def scraper_loop(self):
         self.app.app_context().push()
+        self.writer.start()
+        await self.store_moderation_setting()
+        workers = [
+            asyncio.ensure_future(self.poll_worker(self.video_scheduler, True))
+            for _ in range(self.config.video_concurrency)
+        ] + [
+            asyncio.ensure_future(self.poll_worker(self.dynamic_scheduler, False))
+            for _ in range(self.config.dynamic_concurrency)
+        ] + [asyncio.ensure_future(self.reconcile_loop())]
+        if self.moderator is not None:
+            workers.append(asyncio.ensure_future(self.moderator.run()))
         while True:
             try:
-                await self.scrap()
+                await self.refresh_contents()
             except Exception as err:
                 print(f"Unknown posting exception: {err}")
                 print(traceback.format_exc())
             finally:
                 sys.stdout.flush()
+            await asyncio.sleep(self.config.content_refresh_interval)
 
     def scraper_thread(self, loop):
         asyncio.set_event_loop(loop)
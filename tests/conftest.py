@@ -0,0 +1,95 @@
+import os
+
+import pytest
+from flask import Flask
+
+import app as server
+from dataset import Comment, db, upgrade_schema
+
+# 设置为 PostgreSQL 连接地址（如 postgresql://user@localhost/guardian_test）时，与数据库类型无关的测试也在 PostgreSQL 上运行
+PG_URL_ENV = 'GUARDIAN_TEST_PG_URL'
+
+
+def setup_database(app: Flask, uri: str, readers: int = 0):
+    """按 app.py 的启动顺序建立数据库，调用前需推入 app 的上下文"""
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    db.configure_engine(app, readers=readers)
+    upgrade_schema()
+
+
+def teardown_database(drop: bool = False):
+    db.session.remove()
+    if drop:
+        db.drop_all()
+    db.engine.dispose()
+    if db.reader_engine is not None:
+        db.reader_engine.dispose()
+        db.reader_engine = None
+
+
+def database_app(uri: str, drop: bool = False):
+    app = Flask(__name__)
+    context = app.app_context()
+    context.push()
+    if drop:
+        # 共用的 PostgreSQL 数据库中可能留有上次中断的测试数据
+        app.config['SQLALCHEMY_DATABASE_URI'] = uri
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        db.init_app(app)
+        db.drop_all()
+    setup_database(app, uri)
+    yield app
+    teardown_database(drop)
+    context.pop()
+
+
+@pytest.fixture(params=['sqlite', 'postgresql'])
+def app(request, tmp_path):
+    """与数据库类型无关的测试使用的数据库，未设置 GUARDIAN_TEST_PG_URL 时跳过 PostgreSQL"""
+    if request.param == 'postgresql':
+        uri = os.environ.get(PG_URL_ENV)
+        if not uri:
+            pytest.skip(f"{PG_URL_ENV} is not set")
+        yield from database_app(uri, drop=True)
+    else:
+        yield from database_app(f"sqlite:///{tmp_path / 'db.sqlite'}")
+
+
+@pytest.fixture
+def sqlite_app(tmp_path):
+    yield from database_app(f"sqlite:///{tmp_path / 'db.sqlite'}")
+
+
+@pytest.fixture
+def server_app(tmp_path):
+    """app.py 中的 Flask 应用，与默认启动参数一样使用带只读连接池的 SQLite 数据库"""
+    context = server.app.app_context()
+    context.push()
+    setup_database(server.app, f"sqlite:///{tmp_path / 'db.sqlite'}", readers=8)
+    yield server.app
+    teardown_database()
+    context.pop()
+
+
+def comment_json(rpid: int, oid: int = 10, mid: int = 100, ctime: int = 1700000000, root: int = 0,
+                 type_: int = 1, name: str = "用户", like: int = 0) -> dict:
+    """接口返回的评论格式"""
+    return {
+        'rpid': rpid,
+        'oid': oid,
+        'type': type_,
+        'mid': mid,
+        'ctime': ctime,
+        'rcount': 0,
+        'like': like,
+        'root': root,
+        'parent': root,
+        'content': {'message': f"评论 {rpid}"},
+        'member': {'uname': name},
+    }
+
+
+def make_comment(rpid: int, uploader: int = 1, **kwargs) -> Comment:
+    return Comment(comment_json(rpid, **kwargs), "视频", uploader)
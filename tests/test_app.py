@@ -0,0 +1,18 @@
+from dataset import STATUS_FLAGGED, Comment, compute_statistics, db, read_statistics, upsert_comments
+from tests.conftest import make_comment
+
+
+def test_batch_flag_counts_each_comment_once(server_app):
+    upsert_comments(db.session, [make_comment(1), make_comment(2), make_comment(3)])
+    db.session.commit()
+    db.session.remove()
+
+    with server_app.test_client() as client:
+        response = client.post('/try_delete_comments', json={'rpids': [3, 3, "3", 4, "x"]})
+    assert response.status_code == 200
+    assert response.get_json()['results'] == {'3': 'flagged', '4': 'not_found', 'x': 'invalid'}
+
+    db.session.remove()
+    assert db.session.get(Comment, 3).guardian_status == STATUS_FLAGGED
+    assert read_statistics(db.session)['flagged_comments'] == 1
+    assert read_statistics(db.session) == compute_statistics(db.session)
@@ -0,0 +1,102 @@
+import asyncio
+import time
+
+import pytest
+from bilibili_api import exceptions
+from flask import Flask
+
+from circuit import CircuitBreaker, CircuitOpenError
+from config import Config
+from dataset import db
+from scraper import Scraper
+
+
+def blocked_error():
+    return exceptions.ResponseCodeException(-412, "请求被拦截")
+
+
+def half_open(breaker: CircuitBreaker):
+    breaker.state = CircuitBreaker.OPEN
+    breaker.retry_at = time.monotonic() - 1
+
+
+def test_failures_while_open_do_not_escalate():
+    breaker = CircuitBreaker('comment', threshold=3, base_delay=120)
+    for _ in range(7):
+        breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.level == 0
+    assert breaker.failures == 0
+    assert breaker.retry_in() <= 120
+    assert breaker.total_blocks == 7
+
+
+def test_failed_probe_escalates():
+    breaker = CircuitBreaker('comment', threshold=3, base_delay=120)
+    for _ in range(3):
+        breaker.record_failure()
+    half_open(breaker)
+    assert breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.level == 1
+    assert not breaker.probing
+    assert breaker.retry_in() > 60
+
+    half_open(breaker)
+    assert breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.level == 0
+
+
+def test_cancelled_probe_releases_breaker():
+    scraper = Scraper(Config(), db, Flask(__name__))
+    breaker = scraper.breakers['comment']
+
+    async def run():
+        half_open(breaker)
+        started = asyncio.Event()
+
+        async def hang(credential):
+            started.set()
+            await asyncio.Event().wait()
+
+        async def succeed(credential):
+            return 'ok'
+
+        probe = asyncio.ensure_future(scraper.limited('comment', hang)())
+        await started.wait()
+        with pytest.raises(CircuitOpenError):
+            await scraper.limited('comment', succeed)()
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        assert not breaker.probing
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        assert await scraper.limited('comment', succeed)() == 'ok'
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    asyncio.run(run())
+
+
+def test_in_flight_failures_open_breaker_once():
+    scraper = Scraper(Config(breaker_threshold=2), db, Flask(__name__))
+    breaker = scraper.breakers['comment']
+
+    async def run():
+        gate = asyncio.Event()
+
+        async def blocked(credential):
+            await gate.wait()
+            raise blocked_error()
+
+        calls = [asyncio.ensure_future(scraper.limited('comment', blocked)()) for _ in range(5)]
+        await asyncio.sleep(0)
+        gate.set()
+        results = await asyncio.gather(*calls, return_exceptions=True)
+        assert all(isinstance(result, exceptions.ResponseCodeException) for result in results)
+
+    asyncio.run(run())
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.level == 0
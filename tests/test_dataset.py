@@ -0,0 +1,232 @@
+import threading
+import time
+from datetime import datetime
+
+import pytest
+from sqlalchemy import inspect, text
+
+from dataset import MIGRATIONS, STATUS_DELETED, Comment, Content, SchemaVersion, Statistic, StatisticDelta, \
+    UserReputation, compute_statistics, db, deletable_comments, mark_deleted_comments, rank_bad_users, \
+    read_statistics, rebuild_reputation, reconcile_statistics, top_reputations, upgrade_schema, upsert_comments
+from tests.conftest import make_comment
+
+# 超出 32 位整数范围的 ID
+BIG = 2 ** 40
+
+
+def statuses() -> dict:
+    db.session.expire_all()
+    return dict(db.session.query(Comment.rpid, Comment.guardian_status).all())
+
+
+def assert_counters_consistent():
+    assert read_statistics(db.session) == compute_statistics(db.session)
+    counted = {mid: (deleted, total) for mid, deleted, total in db.session.query(
+        UserReputation.mid, UserReputation.deleted_count, UserReputation.total_comments
+    )}
+    db.session.execute(UserReputation.__table__.delete())
+    rebuild_reputation(db.session)
+    rebuilt = {mid: (deleted, total) for mid, deleted, total in db.session.query(
+        UserReputation.mid, UserReputation.deleted_count, UserReputation.total_comments
+    )}
+    db.session.rollback()
+    assert counted == rebuilt
+
+
+def test_upsert_comments(app):
+    assert upsert_comments(db.session, [make_comment(BIG + 1, like=1), make_comment(BIG + 2, mid=BIG)]) == 2
+    db.session.commit()
+    # 已有评论刷新点赞数和昵称，不重复计数
+    assert upsert_comments(db.session, [
+        make_comment(BIG + 1, like=5, name="新昵称"), make_comment(BIG + 3, oid=BIG, type_=11)
+    ]) == 1
+    db.session.commit()
+
+    db.session.expire_all()
+    comment_ = db.session.get(Comment, BIG + 1)
+    assert (comment_.like, comment_.mname) == (5, "新昵称")
+    assert db.session.get(Comment, BIG + 2).mid == BIG
+    assert read_statistics(db.session)['total_comments'] == 3
+    assert_counters_consistent()
+
+
+def test_statistics_deltas(app):
+    base = dict(db.session.query(Statistic.name, Statistic.value))
+    upsert_comments(db.session, [make_comment(1), make_comment(2, mid=200)])
+    db.session.commit()
+    # 写入只追加增量，不修改计数行
+    assert dict(db.session.query(Statistic.name, Statistic.value)) == base
+    assert db.session.query(StatisticDelta).count() > 0
+    assert read_statistics(db.session)['total_comments'] == 2
+
+    reconcile_statistics(db.session)
+    db.session.commit()
+    assert db.session.query(StatisticDelta).count() == 0
+    assert read_statistics(db.session) == compute_statistics(db.session)
+    assert db.session.get(Statistic, 'unique_users').value == 2
+
+
+def test_mark_deleted_comments(app):
+    upsert_comments(db.session, [
+        make_comment(BIG + 1, ctime=1700000000),
+        make_comment(BIG + 2, ctime=1700000100),
+        make_comment(BIG + 3, ctime=1700000200),
+        make_comment(BIG + 4, ctime=1700000200, root=BIG + 2, mid=200),
+        make_comment(BIG + 5, ctime=1700000300, root=BIG + 3, mid=200),
+        make_comment(BIG + 6, ctime=1700000400, root=BIG + 3, mid=200),
+    ])
+    db.session.commit()
+
+    # 根评论 BIG + 2 和 BIG + 3 下的子评论 BIG + 6 不见了
+    deleted = mark_deleted_comments(
+        db.session, 10, datetime.utcfromtimestamp(1700000050), {BIG + 3}, {BIG + 3: [BIG + 5]}
+    )
+    db.session.commit()
+    assert deleted == 2
+    assert statuses() == {
+        BIG + 1: 1, BIG + 2: STATUS_DELETED, BIG + 3: 1,
+        BIG + 4: STATUS_DELETED, BIG + 5: 1, BIG + 6: STATUS_DELETED,
+    }
+    assert_counters_consistent()
+
+    # 重新出现的评论恢复可见
+    mark_deleted_comments(db.session, 10, None, set(), {BIG + 3: [BIG + 5, BIG + 6]})
+    db.session.commit()
+    assert statuses()[BIG + 6] == 1
+    assert_counters_consistent()
+
+
+def test_bad_user_queries(app):
+    upsert_comments(db.session, [
+        make_comment(BIG + 1, mid=BIG, ctime=1700000000, name="旧昵称"),
+        make_comment(BIG + 2, mid=BIG, ctime=1700000100, name="甲"),
+        make_comment(BIG + 3, mid=BIG, ctime=1700000200),
+        make_comment(BIG + 4, mid=300, ctime=1700000300, name="乙"),
+        make_comment(BIG + 5, mid=300, ctime=1700000400, uploader=2),
+    ])
+    db.session.commit()
+    mark_deleted_comments(db.session, 10, datetime.utcfromtimestamp(1699999999), {BIG + 3, BIG + 5}, {})
+    db.session.commit()
+
+    expected = [
+        (BIG, "甲", datetime.utcfromtimestamp(1700000100), 2),
+        (300, "乙", datetime.utcfromtimestamp(1700000300), 1),
+    ]
+    assert [tuple(row) for row in rank_bad_users(db.session)] == expected
+    assert [tuple(row) for row in rank_bad_users(db.session, 2)] == []
+    reputations = [tuple(row) for row in top_reputations(db.session)]
+    assert [(mid, count) for mid, _, _, count in reputations] == [(BIG, 2), (300, 1)]
+    assert deletable_comments(db.session, [BIG, 300]) == {BIG: [(1, 10, BIG + 3)], 300: [(1, 10, BIG + 5)]}
+    assert deletable_comments(db.session, [BIG], Comment.uploader == 2) == {BIG: []}
+    assert_counters_consistent()
+
+
+def test_upgrade_from_old_schema(app):
+    db.session.add(Content(10, 1, 1, "视频", 1700000000))
+    upsert_comments(db.session, [make_comment(BIG + 1), make_comment(BIG + 2)])
+    db.session.commit()
+    db.session.remove()
+
+    # 退回到迁移之前的结构：没有 uploader、is_new 列和新增的索引，也没有计数和信誉记录
+    with db.engine.begin() as connection:
+        for index in Comment.__table__.indexes | Content.__table__.indexes:
+            index.drop(connection, checkfirst=True)
+        connection.execute(text("ALTER TABLE comment DROP COLUMN uploader"))
+        connection.execute(text("ALTER TABLE content DROP COLUMN is_new"))
+        connection.execute(text("ALTER TABLE scrape_state DROP COLUMN uploader_filled"))
+        connection.execute(text("DELETE FROM statistic"))
+        connection.execute(text("DELETE FROM user_reputation"))
+        connection.execute(SchemaVersion.__table__.delete())
+
+    upgrade_schema()
+
+    inspector = inspect(db.engine)
+    assert {'uploader'} <= {column['name'] for column in inspector.get_columns('comment')}
+    assert {'is_new'} <= {column['name'] for column in inspector.get_columns('content')}
+    assert {'uploader_filled'} <= {column['name'] for column in inspector.get_columns('scrape_state')}
+    indexes = {index['name'] for index in inspector.get_indexes('comment')}
+    assert {index.name for index in Comment.__table__.indexes} <= indexes
+    assert db.session.get(SchemaVersion, 1).version == len(MIGRATIONS)
+    assert {uploader for uploader, in db.session.query(Comment.uploader)} == {1}
+    assert db.session.get(Content, (10, 1)).is_new
+    assert read_statistics(db.session)['total_comments'] == 2
+    assert db.session.get(UserReputation, 100).total_comments == 2
+
+
+def test_concurrent_upgrades(app):
+    # 两个进程同时以空数据库启动
+    db.session.remove()
+    db.drop_all()
+    barrier = threading.Barrier(2)
+    errors = []
+
+    def upgrade():
+        with app.app_context():
+            barrier.wait()
+            try:
+                upgrade_schema()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                db.session.remove()
+
+    threads = [threading.Thread(target=upgrade) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert db.session.get(SchemaVersion, 1).version == len(MIGRATIONS)
+
+
+def test_concurrent_inserts_of_new_user(app):
+    if db.engine.dialect.name == 'sqlite':
+        pytest.skip("SQLite 的写事务互斥，不会同时插入")
+    # 本会话插入新用户的第一条评论后尚未提交，另一个进程同时写入同一用户的评论
+    upsert_comments(db.session, [make_comment(1, mid=100)])
+    errors = []
+
+    def insert():
+        with app.app_context():
+            try:
+                upsert_comments(db.session, [make_comment(2, mid=100)])
+                db.session.commit()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                db.session.remove()
+
+    thread = threading.Thread(target=insert)
+    thread.start()
+    # 等另一个会话阻塞在同一主键上再提交
+    time.sleep(0.5)
+    db.session.commit()
+    thread.join()
+
+    assert errors == []
+    db.session.expire_all()
+    assert db.session.get(UserReputation, 100).total_comments == 2
+
+
+def test_partial_indexes(app):
+    upsert_comments(db.session, [make_comment(BIG + 1)])
+    db.session.commit()
+    if db.engine.dialect.name == 'postgresql':
+        definitions = dict(db.session.execute(text(
+            "SELECT indexname, indexdef FROM pg_indexes WHERE tablename = 'comment'"
+        )).all())
+    else:
+        definitions = dict(db.session.execute(text(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = 'comment'"
+        )).all())
+    for name in ('ix_comment_deleted_mid', 'ix_comment_visible_mid'):
+        assert 'WHERE' in definitions[name] and 'guardian_status' in definitions[name]
+
+
+def test_deletable_comments_returns_every_comment(app):
+    upsert_comments(db.session, [make_comment(BIG + i, mid=BIG, ctime=1700000000 + i) for i in range(250)])
+    db.session.commit()
+    comments = deletable_comments(db.session, [BIG])[BIG]
+    assert len(comments) == 250
+    assert comments[0] == (1, 10, BIG + 249)
@@ -0,0 +1,144 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+import pytest
+from aiohttp import web
+from bilibili_api import comment, request_settings
+
+from config import Config
+from dataset import MODERATION_TYPE, STATUS_DELETED, STATUS_FLAGGED, STATUS_MODERATION_FAILED, Comment, \
+    compute_statistics, db, finish_moderation, flag_comments, mark_deleted_comments, read_statistics, \
+    upsert_comments
+from scraper import Scraper
+from tests.conftest import make_comment
+from worker import LeaseWorker
+
+# 测试用的 UP 主凭据
+UPLOADER = {'sessdata': "uploader-sessdata", 'bili_jct': "uploader-jct"}
+
+
+@pytest.fixture
+def reply_api(monkeypatch):
+    """在本地启动代替 B 站删除评论接口的 HTTP 服务，按 rpid 返回指定的错误代码"""
+    # 不向 B 站申请 buvid 和 bili_ticket，所有请求都只发往本地服务
+    monkeypatch.setattr(request_settings, 'get_enable_auto_buvid', lambda: False)
+    monkeypatch.setattr(request_settings, 'get_enable_bili_ticket', lambda: False)
+
+    @asynccontextmanager
+    async def serve(codes: dict):
+        requests = []
+
+        async def delete(request):
+            form = dict(await request.post())
+            requests.append((form, request.cookies.get('SESSDATA')))
+            code = codes.get(int(form['rpid']), 0)
+            return web.json_response({'code': code, 'message': "0" if code == 0 else "拒绝", 'ttl': 1})
+
+        server = web.Application()
+        server.router.add_post('/x/v2/reply/del', delete)
+        runner = web.AppRunner(server)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        monkeypatch.setitem(comment.API['comment']['del'], 'url', f"http://127.0.0.1:{port}/x/v2/reply/del")
+        try:
+            yield requests
+        finally:
+            await runner.cleanup()
+    return serve
+
+
+def moderating_scraper(app, **kwargs) -> Scraper:
+    config = Config(users=[1], moderation=True, rate_limits={'moderation': (100.0, 10)}, **UPLOADER, **kwargs)
+    return Scraper(config, db, app)
+
+
+def statuses() -> dict:
+    db.session.expire_all()
+    return dict(db.session.query(Comment.rpid, Comment.guardian_status).all())
+
+
+def test_moderation_against_reply_api(app, reply_api):
+    upsert_comments(db.session, [make_comment(rpid) for rpid in range(1, 6)])
+    flag_comments(db.session, [1, 2, 3, 4])
+    db.session.commit()
+    scraper = moderating_scraper(app)
+
+    async def run():
+        scraper.writer.start()
+        # 1 删除成功，2 已不存在，3 被拒绝，4 被风控拦截
+        async with reply_api({2: 12022, 3: -403, 4: -412}) as requests:
+            await scraper.moderator.drain()
+        return requests
+
+    requests = asyncio.run(run())
+    assert sorted(int(form['rpid']) for form, _ in requests) == [1, 2, 3, 4]
+    assert all(form['oid'] == '10' and form['type'] == '1' and form['csrf'] == UPLOADER['bili_jct']
+               for form, _ in requests)
+    assert {sessdata for _, sessdata in requests} == {UPLOADER['sessdata']}
+    assert statuses() == {
+        1: STATUS_DELETED, 2: STATUS_DELETED, 3: STATUS_MODERATION_FAILED, 4: STATUS_FLAGGED, 5: 1,
+    }
+    assert read_statistics(db.session) == compute_statistics(db.session)
+
+
+def test_moderation_requires_uploader_credential(app, tmp_path):
+    credential_file = tmp_path / 'credentials.txt'
+    credential_file.write_text("SESSDATA=pool; bili_jct=pool\n")
+    config = Config(moderation=True, credential_file=str(credential_file))
+    assert config.credential is not None
+    assert Scraper(config, db, app).moderator is None
+    assert moderating_scraper(app).moderator is not None
+
+
+def test_rescan_keeps_moderation_state(app):
+    upsert_comments(db.session, [make_comment(1, ctime=1700000000), make_comment(2, ctime=1700000100)])
+    flag_comments(db.session, [1, 2])
+    finish_moderation(db.session, [], [1])
+    db.session.commit()
+
+    def rescan(scraper: Scraper):
+        async def run():
+            scraper.writer.start()
+            await scraper.store_moderation_setting()
+            await scraper.writer.submit(mark_deleted_comments, db.session, 10,
+                                        datetime.utcfromtimestamp(1699999999), {1, 2}, {})
+
+        asyncio.run(run())
+        return statuses()
+
+    # 启用自动删除的进程把设置写入数据库，未启用自动删除的进程重新抓取时也保持标记
+    rescan(moderating_scraper(app))
+    assert rescan(Scraper(Config(users=[1]), db, app)) == {1: STATUS_MODERATION_FAILED, 2: STATUS_FLAGGED}
+    # 为数据库关闭自动删除后，仍可见的已标记评论恢复可见，自动删除失败的评论保持原状态
+    assert rescan(Scraper(Config(users=[1], disable_moderation=True), db, app)) == {
+        1: STATUS_MODERATION_FAILED, 2: 1
+    }
+    assert read_statistics(db.session) == compute_statistics(db.session)
+
+
+def test_one_worker_moderates_at_a_time(app):
+    workers = [
+        LeaseWorker(moderating_scraper(app), 'a', lease_ttl=60),
+        LeaseWorker(moderating_scraper(app), 'b', lease_ttl=60),
+        LeaseWorker(Scraper(Config(users=[1]), db, app), 'c', lease_ttl=60),
+    ]
+    for worker in workers:
+        worker.ensure_content_lists()
+
+    async def run():
+        for worker in workers:
+            worker.scraper.writer.start()
+        claimed = {}
+        for worker in workers[::-1] + workers:
+            lease = await worker.claim()
+            if lease is not None:
+                claimed.setdefault(worker.worker_id, []).append(lease.type_)
+        return claimed
+
+    claimed = asyncio.run(run())
+    moderators = [worker_id for worker_id, types in claimed.items() if MODERATION_TYPE in types]
+    assert len(moderators) == 1 and moderators[0] != 'c'
+    assert sum(len(types) for types in claimed.values()) == 2
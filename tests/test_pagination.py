@@ -0,0 +1,35 @@
+from bilibili_api.comment import CommentResourceType
+
+from dataset import Comment, db, upsert_comments
+from pagination import KeysetPage
+from tests.conftest import make_comment
+
+DYNAMIC_TYPES = (CommentResourceType.DYNAMIC, CommentResourceType.DYNAMIC_DRAW)
+
+
+def dynamic_queries() -> list:
+    return [Comment.query.filter(Comment.type_ == type_.value) for type_ in DYNAMIC_TYPES]
+
+
+def test_merged_pages(app):
+    # 两种动态交替发布，其中几条发布时间相同；视频评论不应出现在动态页中
+    comments = [
+        make_comment(rpid, type_=DYNAMIC_TYPES[rpid % 2].value, ctime=1700000000 + rpid // 3 * 10)
+        for rpid in range(1, 12)
+    ]
+    comments.append(make_comment(100, type_=CommentResourceType.VIDEO.value, ctime=1700000050))
+    upsert_comments(db.session, comments)
+    db.session.commit()
+    expected = sorted(range(1, 12), key=lambda rpid: (rpid // 3, rpid), reverse=True)
+
+    pages = [KeysetPage(dynamic_queries(), 4)]
+    while pages[-1].has_next:
+        pages.append(KeysetPage(dynamic_queries(), 4, after=pages[-1].next_cursor))
+    assert [[comment_.rpid for comment_ in page.items] for page in pages] == \
+        [expected[0:4], expected[4:8], expected[8:]]
+
+    newer = KeysetPage(dynamic_queries(), 4, before=pages[2].prev_cursor)
+    assert [comment_.rpid for comment_ in newer.items] == expected[4:8] and newer.has_prev
+
+    jumped = KeysetPage(dynamic_queries(), 4, page=2)
+    assert [comment_.rpid for comment_ in jumped.items] == expected[4:8] and jumped.has_next
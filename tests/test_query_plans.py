@@ -0,0 +1,138 @@
+import re
+
+import pytest
+from bilibili_api.comment import CommentResourceType
+from sqlalchemy import event
+
+from config import Config
+from dataset import STATUS_DELETED, Comment, compute_statistics, db, deletable_comments, flag_comments, \
+    on_new_content, rank_bad_users, top_reputations
+from pagination import KeysetPage
+from scraper import Scraper
+from tests.conftest import comment_json
+
+# 这些表上的查询不应整表扫描
+INDEXED_TABLES = ('comment', 'user_reputation')
+
+
+@pytest.fixture
+def query_plans(sqlite_app):
+    """执行函数并对其间的每条查询和更新语句运行 EXPLAIN QUERY PLAN，返回每条语句的计划行
+
+    在语句执行前用同一个连接解释，能看到 mark_deleted_comments 建立的临时表。
+    """
+    def explain(f) -> list:
+        plans = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if not executemany and statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+                rows = cursor.connection.execute(f"EXPLAIN QUERY PLAN {statement}", parameters).fetchall()
+                plans.append([row[-1] for row in rows])
+
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            f()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capture)
+        assert plans
+        return plans
+    return explain
+
+
+def assert_indexed(plan: list, *indexes: str, sorted_by_index: bool = False):
+    """计划中对评论和信誉表的访问都走索引，并且用到了给定的索引
+
+    sorted_by_index 为真时结果必须按索引顺序读出，计划中不能出现临时 B 树排序。
+    """
+    for detail in plan:
+        match = re.match(r'(SCAN|SEARCH) (\w+)', detail)
+        if match and match.group(2) in INDEXED_TABLES:
+            assert 'INDEX' in detail or 'PRIMARY KEY' in detail, plan
+        if sorted_by_index:
+            assert 'USE TEMP B-TREE' not in detail, plan
+    text = '\n'.join(plan)
+    for index in indexes:
+        assert re.search(rf'INDEX {index}\b', text), plan
+
+
+def visible(type_: CommentResourceType, *conditions):
+    return Comment.query.filter(Comment.guardian_status != -1, Comment.type_ == type_.value, *conditions)
+
+
+# /comments 的两个标签页，动态页每种动态类型一个查询
+PAGE_TYPES = {
+    'video': [CommentResourceType.VIDEO],
+    'dynamic': [CommentResourceType.DYNAMIC, CommentResourceType.DYNAMIC_DRAW],
+}
+
+
+@pytest.mark.parametrize('tab', PAGE_TYPES)
+def test_comment_pages(query_plans, tab):
+    queries = [visible(type_) for type_ in PAGE_TYPES[tab]]
+    for page in (
+        lambda: KeysetPage(queries, 50),
+        lambda: KeysetPage(queries, 50, after="1700000000-5"),
+        lambda: KeysetPage(queries, 50, before="1700000000-5"),
+    ):
+        for plan in query_plans(page):
+            assert_indexed(plan, 'ix_comment_type_ctime', sorted_by_index=True)
+
+
+@pytest.mark.parametrize('tab', PAGE_TYPES)
+def test_comment_pages_by_uploader(query_plans, tab):
+    queries = [visible(type_, Comment.uploader == 1) for type_ in PAGE_TYPES[tab]]
+    for plan in query_plans(lambda: KeysetPage(queries, 50, after="1700000000-5")):
+        assert_indexed(plan, 'ix_comment_uploader_type_ctime', sorted_by_index=True)
+
+
+def test_update_comments(sqlite_app, query_plans):
+    # 根评论 1、2、3，1 下有子评论 4、5，3 已标记删除
+    comments = {rpid: comment_json(rpid, ctime=1700000000 + rpid * 10) for rpid in (1, 2, 3)}
+    comments.update({rpid: comment_json(rpid, ctime=1700000100 + rpid, root=1) for rpid in (4, 5)})
+    scraper = Scraper(Config(users=[1]), db, sqlite_app)
+
+    def update(rpids: set):
+        scraped = {rpid: comments[rpid] for rpid in rpids}
+        scraper.update_comments("视频", 10, CommentResourceType.VIDEO, 1, scraped, {}, rpids & {1, 2, 3},
+                                {1: list(rpids & {4, 5})}, full_scrape=True)
+        db.session.commit()
+
+    update({1, 2, 3, 4, 5})
+    flag_comments(db.session, [3])
+    db.session.commit()
+    # 根评论 2 和子评论 5 消失，比对删除状态（仍可见的 3 恢复可见）、记录事件并写入评论
+    plans = query_plans(lambda: update({1, 3, 4}))
+    for plan in plans:
+        assert_indexed(plan)
+        assert not any('FOR ORDER BY' in detail for detail in plan), plan
+    text = '\n'.join('\n'.join(plan) for plan in plans)
+    for index in ('ix_comment_oid_root_ctime', 'ix_comment_root'):
+        assert f'INDEX {index}' in text
+    db.session.expire_all()
+    assert [db.session.get(Comment, rpid).guardian_status for rpid in (2, 5, 3)] == [STATUS_DELETED, STATUS_DELETED, 1]
+
+
+@pytest.mark.parametrize('uploader', [None, 1])
+def test_rank_bad_users(query_plans, uploader):
+    for plan in query_plans(lambda: rank_bad_users(db.session, uploader)):
+        assert_indexed(plan, 'ix_comment_(status_uploader|deleted_mid)')
+
+
+def test_deletable_comments(query_plans):
+    for plan in query_plans(lambda: deletable_comments(db.session, [1, 2], ~on_new_content())):
+        assert_indexed(plan, 'ix_comment_(mid_status|visible_mid)')
+
+
+def test_top_reputations(query_plans):
+    for plan in query_plans(lambda: top_reputations(db.session)):
+        assert_indexed(plan, 'ix_user_reputation_deleted')
+
+
+def test_statistics(query_plans):
+    plans = query_plans(lambda: compute_statistics(db.session))
+    assert len(plans) == 8
+    for plan in plans:
+        assert_indexed(plan)
+    text = '\n'.join('\n'.join(plan) for plan in plans)
+    for index in ('ix_comment_type_oid', 'ix_comment_status_uploader'):
+        assert f'INDEX {index}' in text
@@ -0,0 +1,59 @@
+import asyncio
+
+from config import Config
+from dataset import MIGRATIONS, Content, SchemaVersion, db, rebuild_reputation, upgrade_schema
+from scraper import Scraper
+
+
+def test_migrations_with_single_writer_connection(server_app):
+    assert db.reader_engine is not None
+    assert SchemaVersion.query.get(1).version == len(MIGRATIONS)
+
+    # 会话持有唯一的写连接时，仍能执行待执行的迁移
+    SchemaVersion.query.get(1).version = len(MIGRATIONS) - 1
+    db.session.commit()
+    assert SchemaVersion.query.get(1) is not None
+    upgrade_schema()
+    assert SchemaVersion.query.get(1).version == len(MIGRATIONS)
+
+    db.session.remove()
+    with db.engine.begin() as connection:
+        rebuild_reputation(connection)
+
+
+def test_only_page_views_use_reader(server_app):
+    for method, read_only in (('GET', True), ('POST', False), ('GET', True)):
+        with server_app.test_request_context('/comments', method=method):
+            server_app.preprocess_request()
+            assert db.session.info['read_only'] is read_only
+
+
+
+def test_full_refresh_with_readers(server_app, monkeypatch):
+    scraper = Scraper(Config(users=[1], content_full_refresh_every=1), db, server_app)
+    titles = iter(["旧标题", "旧标题", "新标题", "新标题"])
+
+    class FakeUser:
+        async def get_user_info(self):
+            return {'name': "甲"}
+
+    async def videos(mid, full):
+        title = next(titles)
+        return [Content(10, 1, mid, title, 1700000000), Content(11, 1, mid, title, 1700000100)]
+
+    async def no_contents(mid, full):
+        return []
+
+    monkeypatch.setattr(scraper, 'user_obj', lambda mid, credential: FakeUser())
+    monkeypatch.setattr(scraper, 'fetch_videos', videos)
+    monkeypatch.setattr(scraper, 'fetch_dynamics', no_contents)
+    scraper.writer.start()
+
+    async def refresh():
+        # 第一次和第三次为完整刷新，会先清空缓存再写入
+        return [await scraper.get_user_contents(1) for _ in range(4)]
+
+    for recent_videos, _ in asyncio.run(refresh()):
+        assert [content.oid for content in recent_videos] == [11, 10]
+    db.session.remove()
+    assert {content.title for content in Content.query.all()} == {"新标题"}
@@ -0,0 +1,92 @@
+import asyncio
+import threading
+
+from bilibili_api.comment import CommentResourceType
+from sqlalchemy import event
+
+from config import Config
+from dataset import Comment, Content, ScrapeState, Uploader, db, upsert_comments
+from scraper import Scraper
+from tests.conftest import comment_json, make_comment
+
+
+def test_uploader_names_survive_restart(app):
+    db.session.add(Uploader(1, "甲"))
+    db.session.commit()
+
+    scraper = Scraper(Config(users=[1, 2]), db, app)
+    assert scraper.uploaders() == [(1, "甲"), (2, "2")]
+
+
+def test_first_refresh_fetches_missing_name(app, monkeypatch):
+    db.session.add(Content(10, 1, 1, "视频", 1700000000))
+    db.session.commit()
+    scraper = Scraper(Config(users=[1]), db, app)
+    calls = []
+
+    class FakeUser:
+        async def get_user_info(self):
+            calls.append(1)
+            return {'name': "甲"}
+
+    async def no_contents(mid, full):
+        return []
+
+    monkeypatch.setattr(scraper, 'user_obj', lambda mid, credential: FakeUser())
+    monkeypatch.setattr(scraper, 'fetch_videos', no_contents)
+    monkeypatch.setattr(scraper, 'fetch_dynamics', no_contents)
+
+    # 内容列表已缓存，不是完整刷新，但昵称尚未保存
+    scraper.writer.start()
+    asyncio.run(scraper.get_user_contents(1))
+    asyncio.run(scraper.get_user_contents(1))
+    assert len(calls) == 1
+    assert db.session.get(Uploader, 1).name == "甲"
+    assert Scraper(Config(users=[1]), db, app).uploaders() == [(1, "甲")]
+
+
+def test_content_cache_stays_off_the_event_loop(app, monkeypatch):
+    scraper = Scraper(Config(users=[1]), db, app)
+    db.session.remove()
+    checkouts = []
+    event.listen(db.engine, 'checkout', lambda *args: checkouts.append(threading.current_thread()))
+
+    class FakeUser:
+        async def get_user_info(self):
+            return {'name': "甲"}
+
+    async def videos(mid, full):
+        return [Content(10, 1, mid, "视频", 1700000000)]
+
+    async def no_contents(mid, full):
+        return []
+
+    monkeypatch.setattr(scraper, 'user_obj', lambda mid, credential: FakeUser())
+    monkeypatch.setattr(scraper, 'fetch_videos', videos)
+    monkeypatch.setattr(scraper, 'fetch_dynamics', no_contents)
+    scraper.writer.start()
+    recent_videos, _ = asyncio.run(scraper.get_user_contents(1))
+
+    assert [(content.oid, content.title) for content in recent_videos] == [(10, "视频")]
+    assert checkouts and threading.main_thread() not in checkouts
+
+
+def test_comment_uploaders_filled_once(app):
+    # 升级前抓取的评论没有记录所属的 UP 主
+    upsert_comments(db.session, [make_comment(1, uploader=None), make_comment(2, uploader=None)])
+    db.session.commit()
+    scraper = Scraper(Config(users=[1]), db, app)
+
+    def store():
+        scraper.store_object("视频", 10, CommentResourceType.VIDEO, 1, {1: comment_json(1)}, {}, {1}, {},
+                             False, None)
+        db.session.commit()
+        db.session.expire_all()
+        return {rpid: db.session.get(Comment, rpid).uploader for rpid in (1, 2)}
+
+    assert store() == {1: 1, 2: 1}
+    assert db.session.get(ScrapeState, (10, CommentResourceType.VIDEO.value)).uploader_filled
+    # 之后的抓取不再执行补全的 UPDATE
+    db.session.query(Comment).filter(Comment.rpid == 2).update({Comment.uploader: None})
+    db.session.commit()
+    assert store() == {1: 1, 2: None}
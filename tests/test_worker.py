@@ -0,0 +1,45 @@
+import asyncio
+
+from config import Config
+from dataset import CONTENT_LIST_TYPE, ScrapeLease, db
+from scraper import Scraper
+from worker import LeaseWorker
+
+
+def make_worker(app, worker_id: str) -> LeaseWorker:
+    return LeaseWorker(Scraper(Config(users=[1]), db, app), worker_id, lease_ttl=60)
+
+
+def test_concurrent_start_creates_content_list_once(app, monkeypatch):
+    make_worker(app, 'a').ensure_content_lists()
+
+    class Missing:
+        @staticmethod
+        def get(key):
+            return None
+
+    # 模拟另一个进程在检查之后、插入之前创建了同一行
+    monkeypatch.setattr(ScrapeLease, 'query', Missing())
+    make_worker(app, 'b').ensure_content_lists()
+    monkeypatch.undo()
+    assert ScrapeLease.query.filter_by(type_=CONTENT_LIST_TYPE).count() == 1
+
+
+def test_claim_and_release_through_writer(app):
+    first = make_worker(app, 'a')
+    second = make_worker(app, 'b')
+    first.ensure_content_lists()
+
+    async def run():
+        first.scraper.writer.start()
+        second.scraper.writer.start()
+        lease = await first.claim()
+        assert lease is not None and lease.is_content_list()
+        assert await second.claim() is None
+        await first.release(lease, 0)
+        return await second.claim()
+
+    lease = asyncio.run(run())
+    assert lease is not None
+    db.session.expire_all()
+    assert db.session.get(ScrapeLease, (1, CONTENT_LIST_TYPE)).worker == 'b'
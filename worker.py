@@ -0,0 +1,226 @@
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import traceback
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional
+
+from bilibili_api.comment import CommentResourceType
+from flask import Flask
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+
+from circuit import CircuitOpenError
+from config import Config, add_arguments
+from dataset import db, upgrade_schema, ScrapeLease, CONTENT_LIST_TYPE, MODERATION_TYPE
+from scheduler import adapt_interval
+from scraper import Scraper
+
+
+class LeaseWorker:
+    """独立的抓取进程，通过共享数据库中的租约表与其他进程协调
+
+    每个对象同一时间只会被一个进程领取：领取时用条件更新抢占到期且无有效租约的行，
+    抓取期间定期续约，完成后释放租约并写入下次到期时间。进程崩溃后租约过期，对象会被其他进程重新领取。
+    租约表的读写都交给写入线程执行，不阻塞事件循环中正在进行的请求。
+    """
+
+    def __init__(self, scraper: Scraper, worker_id: str, lease_ttl: int = 300, idle_interval: float = 5):
+        self.scraper = scraper
+        self.config = scraper.config
+        self.db = scraper.db
+        self.worker_id = worker_id
+        self.lease_ttl = lease_ttl
+        self.idle_interval = idle_interval
+
+    def ensure_lease(self, oid: int, type_: int, uploader: int, oname: str, interval: float):
+        if ScrapeLease.query.get((oid, type_)) is not None:
+            return
+        self.db.session.add(ScrapeLease(oid, type_, uploader, oname, interval))
+        try:
+            self.db.session.commit()
+        except IntegrityError:
+            # 多个进程同时启动时，其他进程可能刚好创建了同一个任务
+            self.db.session.rollback()
+
+    def ensure_content_lists(self):
+        """为每个 UP 主创建刷新内容列表的任务，启用自动删除时创建自动删除任务"""
+        for mid in self.config.users:
+            self.ensure_lease(mid, CONTENT_LIST_TYPE, mid, str(mid), self.config.content_refresh_interval)
+        if self.scraper.moderator is not None:
+            self.ensure_lease(0, MODERATION_TYPE, 0, "自动删除", self.config.moderation_interval)
+
+    def claimable(self, now: datetime):
+        return or_(ScrapeLease.worker.is_(None), ScrapeLease.lease_expires < now)
+
+    def claim_lease(self, session) -> Optional[ScrapeLease]:
+        """在写入线程中领取一个到期的任务，没有可领取的任务时返回 None"""
+        now = datetime.utcnow()
+        candidates = session.query(ScrapeLease.oid, ScrapeLease.type_). \
+            filter(ScrapeLease.next_due <= now, self.claimable(now))
+        if self.scraper.moderator is None:
+            # 未启用自动删除的进程不领取自动删除任务
+            candidates = candidates.filter(ScrapeLease.type_ != MODERATION_TYPE)
+        candidates = candidates.order_by(ScrapeLease.next_due).limit(10).all()
+        for oid, type_ in candidates:
+            # 条件更新保证同一行只会被一个进程抢到
+            claimed = session.query(ScrapeLease). \
+                filter(ScrapeLease.oid == oid, ScrapeLease.type_ == type_). \
+                filter(ScrapeLease.next_due <= now, self.claimable(now)). \
+                update({
+                    ScrapeLease.worker: self.worker_id,
+                    ScrapeLease.lease_expires: now + timedelta(seconds=self.lease_ttl)
+                }, synchronize_session=False)
+            if claimed:
+                lease = session.query(ScrapeLease).get((oid, type_))
+                # 交给事件循环使用，不随写入线程的提交过期
+                session.expunge(lease)
+                return lease
+        return None
+
+    async def claim(self) -> Optional[ScrapeLease]:
+        return await self.scraper.writer.submit(self.claim_lease, self.db.session)
+
+    def owned(self, session, lease: ScrapeLease):
+        return session.query(ScrapeLease).filter(
+            ScrapeLease.oid == lease.oid,
+            ScrapeLease.type_ == lease.type_,
+            ScrapeLease.worker == self.worker_id
+        )
+
+    def renew_lease(self, session, lease: ScrapeLease):
+        self.owned(session, lease).update({
+            ScrapeLease.lease_expires: datetime.utcnow() + timedelta(seconds=self.lease_ttl)
+        }, synchronize_session=False)
+
+    async def heartbeat(self, lease: ScrapeLease):
+        """抓取期间定期续约"""
+        while True:
+            await asyncio.sleep(self.lease_ttl / 3)
+            await self.scraper.writer.submit(self.renew_lease, self.db.session, lease)
+
+    def release_lease(self, session, lease: ScrapeLease, interval: float, velocity: Optional[float], polled: bool):
+        now = datetime.utcnow()
+        values = {
+            ScrapeLease.worker: None,
+            ScrapeLease.lease_expires: None,
+            ScrapeLease.next_due: now + timedelta(seconds=interval),
+        }
+        if polled:
+            values[ScrapeLease.interval] = interval
+            values[ScrapeLease.velocity] = velocity
+            values[ScrapeLease.last_polled] = now
+        self.owned(session, lease).update(values, synchronize_session=False)
+
+    async def release(self, lease: ScrapeLease, interval: float, velocity: Optional[float] = None,
+                      polled: bool = False):
+        """释放租约并安排下次到期时间"""
+        await self.scraper.writer.submit(self.release_lease, self.db.session, lease, interval, velocity, polled)
+
+    def sync_content_leases(self, session, mid: int, recent: dict):
+        """把 UP 主最近的内容列表同步到租约表"""
+        existing = session.query(ScrapeLease).filter(
+            ScrapeLease.uploader == mid,
+            ScrapeLease.type_ != CONTENT_LIST_TYPE
+        ).all()
+        for lease in existing:
+            key = (lease.oid, lease.type_)
+            if key in recent:
+                lease.oname = recent.pop(key)
+            elif lease.worker is None:
+                # 已经不在最近列表中的对象不再调度
+                session.delete(lease)
+        for (oid, type_), title in recent.items():
+            # 新发现的对象立即到期
+            session.add(ScrapeLease(oid, type_, mid, title, self.config.min_poll_interval))
+
+    async def refresh_content_list(self, mid: int):
+        """刷新 UP 主的内容列表，并同步到租约表"""
+        recent_videos, recent_dynamics = await self.scraper.get_user_contents(mid)
+        recent = {(content.oid, content.type_): content.title for content in recent_videos + recent_dynamics}
+        await self.scraper.writer.submit(self.sync_content_leases, self.db.session, mid, recent)
+
+    async def process(self, lease: ScrapeLease):
+        if lease.is_moderation():
+            # 持有租约期间只有本进程在删除评论，不会重复调用删除接口
+            await self.scraper.moderator.drain()
+            await self.release(lease, self.config.moderation_interval)
+            return
+        if lease.is_content_list():
+            await self.refresh_content_list(lease.oid)
+            await self.release(lease, self.config.content_refresh_interval)
+            return
+
+        new_count, deleted_count = await self.scraper.scrap_object(
+            lease.oid, CommentResourceType(lease.type_), lease.oname, lease.uploader
+        )
+        interval, velocity = lease.interval, lease.velocity
+        if lease.last_polled is not None:
+            interval, velocity = adapt_interval(
+                lease.interval, lease.velocity, new_count + deleted_count,
+                (datetime.utcnow() - lease.last_polled).total_seconds(),
+                self.config.min_poll_interval, self.config.max_poll_interval
+            )
+        await self.release(lease, interval, velocity, polled=True)
+        if lease.type_ == CommentResourceType.VIDEO.value:
+            self.scraper.update_video_rate(1)
+
+    async def slot(self):
+        """一个抓取协程：循环领取、抓取、释放任务"""
+        while True:
+            lease = await self.claim()
+            if lease is None:
+                await asyncio.sleep(self.idle_interval)
+                continue
+            heartbeat = asyncio.ensure_future(self.heartbeat(lease))
+            try:
+                await self.process(lease)
+            except CircuitOpenError as err:
+                # 熔断时把任务推迟到熔断结束后，交给之后的领取者
+                print(f"推迟抓取 {lease.oid}：{err}")
+                await self.release(lease, max(err.retry_in, self.config.min_poll_interval))
+            except Exception as err:
+                print(f"抓取 {lease.oid} 失败：{err}")
+                print(traceback.format_exc())
+                await self.release(lease, lease.interval)
+            finally:
+                heartbeat.cancel()
+                sys.stdout.flush()
+
+    async def run(self):
+        self.ensure_content_lists()
+        self.scraper.writer.start()
+        await self.scraper.store_moderation_setting()
+        slots = self.config.video_concurrency + self.config.dynamic_concurrency
+        print(f"抓取进程 {self.worker_id} 启动，并发数 {slots}")
+        await asyncio.gather(*[self.slot() for _ in range(slots)], self.scraper.reconcile_loop())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Start a Bilibili guardian scraping worker")
+    parser.add_argument('--db', type=str, help="shared database URI", required=True)
+    add_arguments(parser)
+    parser.add_argument('--worker_id', type=str, help="unique name of this worker, defaults to host name and pid")
+    parser.add_argument('--lease_ttl', type=int, default=300,
+                        help="seconds before the lease of a crashed worker expires")
+    parser.add_argument('--pool_size', type=int, help="database connections kept open (PostgreSQL)")
+    parser.add_argument('--max_overflow', type=int, help="extra database connections allowed under load (PostgreSQL)")
+
+    args = parser.parse_args()
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.db
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+    app.app_context().push()
+
+    db.init_app(app)
+    db.configure_engine(app, pool_size=args.pool_size, max_overflow=args.max_overflow)
+    # 多个进程同时启动时，建表和迁移由数据库锁串行执行
+    upgrade_schema()
+
+    worker_id = args.worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    worker = LeaseWorker(Scraper(Config.from_args(args), db, app), worker_id, lease_ttl=args.lease_ttl)
+    asyncio.run(worker.run())
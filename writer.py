@@ -0,0 +1,121 @@
+import asyncio
+import queue
+import threading
+import time
+import traceback
+
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+
+
+class WriteJob:
+    """交给写入线程执行的一次数据库操作，结果通过 future 交回事件循环"""
+
+    def __init__(self, f, args: tuple, loop: asyncio.AbstractEventLoop, future: asyncio.Future):
+        self.f = f
+        self.args = args
+        self.loop = loop
+        self.future = future
+
+
+class BatchWriter:
+    """独立的数据库写入线程
+
+    抓取协程把写入操作放进有界队列后等待结果，写入线程一次取出多个操作，在同一个事务中执行并统一提交。
+    队列满时新的写入请求会在事件循环中等待，磁盘慢时抓取随之放缓，而不是阻塞所有正在进行的请求。
+    """
+
+    def __init__(self, app: Flask, db: SQLAlchemy, queue_size: int = 16, batch_size: int = 8,
+                 batch_delay: float = 0.05):
+        self.app = app
+        self.db = db
+        self.queue_size = queue_size
+        self.batch_size = batch_size  # 一次提交最多包含的写入操作数
+        self.batch_delay = batch_delay  # 取到第一个操作后等待凑批的时间（秒）
+        self.queue = queue.Queue()
+        self.slots = asyncio.Semaphore(queue_size)
+        self.pending = 0  # 已提交尚未完成的写入操作数
+        self.waiting = 0  # 因队列已满而等待的写入请求数
+        self.batches = 0
+        self.last_batch_size = 0
+        self.last_commit_time = 0.0
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    async def submit(self, f, *args):
+        """在写入线程中执行 f(*args) 并返回其结果"""
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.pending += 1
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.queue.put(WriteJob(f, args, loop, future))
+        return await future
+
+    def finish(self, job: WriteJob, result=None, error: Exception = None):
+        """在事件循环线程中回填结果并释放队列名额"""
+        self.pending -= 1
+        self.slots.release()
+        if job.future.cancelled():
+            return
+        if error is not None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
+
+    def next_batch(self) -> list:
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.batch_delay
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def write(self, batch: list):
+        started = time.monotonic()
+        try:
+            results = [job.f(*job.args) for job in batch]
+            self.db.session.commit()
+        except Exception as err:
+            self.db.session.rollback()
+            if len(batch) > 1:
+                # 批量提交失败时逐个重试，只让出错的那个操作失败
+                for job in batch:
+                    self.write([job])
+                return
+            print(f"写入数据库失败：{err}")
+            print(traceback.format_exc())
+            batch[0].loop.call_soon_threadsafe(self.finish, batch[0], None, err)
+            return
+        self.batches += 1
+        self.last_batch_size = len(batch)
+        self.last_commit_time = time.monotonic() - started
+        for job, result in zip(batch, results):
+            job.loop.call_soon_threadsafe(self.finish, job, result)
+
+    def run(self):
+        with self.app.app_context():
+            while True:
+                self.write(self.next_batch())
+
+    def status(self) -> dict:
+        return {
+            'pending': self.pending,
+            'capacity': self.queue_size,
+            'waiting': self.waiting,
+            'batches': self.batches,
+            'last_batch_size': self.last_batch_size,
+            'last_commit_ms': round(self.last_commit_time * 1000),
+        }